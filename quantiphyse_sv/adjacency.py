@@ -0,0 +1,114 @@
+"""
+Quantiphyse - Region adjacency graph for supervoxel label volumes
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+import scipy.sparse
+
+def adjacent_pairs(labels):
+    """
+    Find neighbouring supervoxels and the size of their shared boundary
+
+    Each axis is handled with a single comparison of the label volume
+    against a copy shifted by one voxel, so the cost is independent of the
+    number of supervoxels.
+
+    :param labels: Cropped labels, -1 outside the mask
+    :return: Tuple of (N x 2 array of label pairs with the smaller label first,
+             number of voxel faces shared by each pair)
+    """
+    labels = np.asarray(labels).astype(np.int64)
+    n_keys = max(int(labels.max()) + 1, 1) if labels.size else 1
+    keys = [np.zeros(0, dtype=np.int64)]
+    for axis in range(labels.ndim):
+        first = labels[tuple(slice(None, -1) if dim == axis else slice(None) for dim in range(labels.ndim))]
+        second = labels[tuple(slice(1, None) if dim == axis else slice(None) for dim in range(labels.ndim))]
+        boundary = (first != second) & (first >= 0) & (second >= 0)
+        first, second = first[boundary], second[boundary]
+        keys.append(np.minimum(first, second) * n_keys + np.maximum(first, second))
+
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    return np.stack([keys // n_keys, keys % n_keys], axis=1), counts.astype(np.int64)
+
+def feature_distances(pairs, means):
+    """
+    Euclidean distance between the mean features of each pair of supervoxels
+
+    :param pairs: N x 2 array of label pairs from ``adjacent_pairs``
+    :param means: Array of mean feature vectors indexed by label, with features
+                  along the last axis
+    :return: Array of N distances
+    """
+    means = np.asarray(means, dtype=np.double)
+    if means.ndim == 1:
+        means = means[:, np.newaxis]
+    return np.sqrt(np.sum((means[pairs[:, 0]] - means[pairs[:, 1]])**2, axis=1))
+
+def _csr_structure(pairs, n_labels):
+    """
+    CSR row pointers and column indices for the symmetric matrix of a set of pairs
+
+    :return: Tuple of (indptr, indices, order) where ``order`` gives the position
+             of each stored entry in the pair values repeated twice
+    """
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]]) + 1
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]]) + 1
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_labels + 1))])
+    return indptr, cols[order], order
+
+def adjacency_matrix(pairs, values, n_labels):
+    """
+    Symmetric sparse matrix of a value for each pair of adjacent supervoxels
+
+    Rows and columns are indexed by output ROI value, i.e. one more than the
+    label, so row 0 (background) is empty.
+
+    :param pairs: N x 2 array of label pairs from ``adjacent_pairs``
+    :param values: Value for each pair
+    :param n_labels: Number of labels
+    :return: ``scipy.sparse.csr_matrix`` of shape (n_labels + 1, n_labels + 1)
+    """
+    indptr, indices, order = _csr_structure(pairs, n_labels)
+    data = np.concatenate([values, values])[order]
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=(n_labels + 1, n_labels + 1))
+
+def save_adjacency(fname, pairs, boundary, distance, n_labels):
+    """
+    Save an adjacency graph as a compressed NumPy ``.npz`` file
+
+    The file contains the CSR arrays ``indptr`` and ``indices`` shared by
+    the ``boundary`` and ``distance`` values, and the matrix ``shape``. Use
+    ``load_adjacency`` to read it back as sparse matrices.
+    """
+    indptr, indices, order = _csr_structure(pairs, n_labels)
+    np.savez_compressed(fname, indptr=indptr, indices=indices,
+                        boundary=np.concatenate([boundary, boundary])[order],
+                        distance=np.concatenate([distance, distance])[order],
+                        shape=np.array([n_labels + 1, n_labels + 1]))
+
+def load_adjacency(fname):
+    """
+    Load an adjacency graph saved by ``save_adjacency``
+
+    :return: Tuple of sparse matrices (shared boundary size, feature distance)
+    """
+    with np.load(fname) as arrays:
+        shape = tuple(arrays["shape"])
+        boundary = scipy.sparse.csr_matrix((arrays["boundary"], arrays["indices"], arrays["indptr"]), shape=shape)
+        distance = scipy.sparse.csr_matrix((arrays["distance"], arrays["indices"], arrays["indptr"]), shape=shape)
+    return boundary, distance
@@ -0,0 +1,299 @@
+"""
+Quantiphyse - Multi-subject batch runner for supervoxel generation
+
+Runs the Supervoxels process over many subjects in a single pool of worker
+processes, rather than one Quantiphyse batch invocation per subject. Cases
+are described in a YAML file::
+
+    n-workers: 4
+    max-memory: 8192
+    retries: 1
+    summary-file: summary.csv
+
+    Supervoxels:
+      n-supervoxels: 100
+      compactness: 0.05
+
+    Cases:
+      - data: subj01/dce.nii.gz
+        roi: subj01/tumour.nii.gz
+        output: out/subj01_sv.nii.gz
+      - data: subj02/dce.nii.gz
+        roi: subj02/tumour.nii.gz
+        output: out/subj02_sv.npz
+        n-supervoxels: 50
+
+Outputs with a ``.npz`` extension are saved in the compact format of
+``labels.save_labels``, which stores only the bounding box of the labels.
+
+Run the batch using::
+
+    python -m quantiphyse_sv.batch cases.yaml
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+import nibabel as nib
+import yaml
+
+from quantiphyse.data import ImageVolumeManagement, load, save
+from quantiphyse.utils import QpException
+
+from .process import run_supervoxels
+from .tiling import bytes_per_voxel, data_itemsize
+from .labels import compact_labels, save_labels
+
+#: Keys in a case which are not process options
+CASE_KEYS = ("data", "roi", "output")
+
+def case_memory(case, options):
+    """
+    Rough working memory needed to process a case, from the data file header
+
+    :return: Estimated memory in bytes, or 0 if the header cannot be read
+    """
+    precision = case.get("precision", options.get("precision", None))
+    try:
+        nii = nib.load(case["data"])
+        itemsize = np.dtype(precision).itemsize if precision else data_itemsize(nii.dataobj)
+    except Exception:
+        return 0
+    shape = nii.shape
+    nvols = shape[3] if len(shape) > 3 else 1
+    ncomp = case.get("n-components", options.get("n-components", 3))
+    return int(np.prod(shape[:3])) * bytes_per_voxel(nvols, ncomp, itemsize)
+
+def run_case(case, options):
+    """
+    Generate supervoxels for a single case and save the output ROI
+
+    This is the job function run in each worker process.
+
+    :param case: Dictionary containing ``data``, optionally ``roi``, the
+                 ``output`` file name and any per-case process options
+    :param options: Process options shared by all cases
+    :return: Dictionary of the output file, number of supervoxels and time taken
+    """
+    start = time.time()
+    ivm = ImageVolumeManagement()
+    ivm.add(load(case["data"]), name="data")
+    process_options = dict(options)
+    process_options.update(dict((key, value) for key, value in case.items() if key not in CASE_KEYS))
+    process_options.update({"data" : "data", "output-name" : "supervoxels"})
+    if case.get("roi", None):
+        roi = load(case["roi"])
+        roi.roi = True
+        ivm.add(roi, name="roi")
+        process_options["roi"] = "roi"
+
+    run_supervoxels(ivm, process_options)
+
+    output = ivm.rois["supervoxels"]
+    outdir = os.path.dirname(case["output"])
+    if outdir and not os.path.exists(outdir):
+        os.makedirs(outdir)
+    if case["output"].endswith(".npz"):
+        offset, cropped = compact_labels(output.raw())
+        save_labels(case["output"], cropped, offset, output.grid.shape, output.grid.affine)
+    else:
+        save(output, case["output"])
+    return {"output" : case["output"], "n_supervoxels" : len(output.regions),
+            "time" : time.time() - start}
+
+def run_batch(cases, options=None, n_workers=1, max_memory=None, retries=1, log=None):
+    """
+    Run a batch of cases over a pool of worker processes
+
+    Cases are started in order, but a case is only admitted while the total
+    estimated memory of the cases in flight stays within ``max_memory``. If
+    the next case does not fit, a later one which does may be started
+    instead. A case is always admitted when nothing else is running. Failed
+    cases are queued again until they have been tried ``retries`` more
+    times. Each output is saved by its worker as soon as the case finishes.
+
+    :param cases: Sequence of case dictionaries, see ``run_case``
+    :param options: Process options shared by all cases
+    :param n_workers: Number of worker processes
+    :param max_memory: Memory budget for cases in flight in Mb, or None for no limit
+    :param retries: Number of times to retry a failed case
+    :param log: Optional file-like object to write progress to
+    :return: Generator of (case index, success, result dictionary or error message)
+             in completion order
+    """
+    options = dict(options or {})
+    budget = max_memory * 1024 * 1024 if max_memory else None
+    estimates = [case_memory(case, options) for case in cases]
+    attempts = [0] * len(cases)
+    queue = collections.deque(range(len(cases)))
+
+    def _log(msg):
+        if log is not None:
+            log.write(msg + "\n")
+            log.flush()
+
+    def _failed(idx, exc):
+        attempts[idx] += 1
+        if attempts[idx] <= retries:
+            _log("Case %i failed (%s) - retrying" % (idx + 1, exc))
+            queue.append(idx)
+            return None
+        _log("Case %i failed: %s" % (idx + 1, exc))
+        return idx, False, str(exc)
+
+    if n_workers <= 1:
+        while queue:
+            idx = queue.popleft()
+            try:
+                result = run_case(cases[idx], options)
+            except Exception as exc:
+                failure = _failed(idx, exc)
+                if failure is not None:
+                    yield failure
+                continue
+            _log("Case %i done: %s (%.1f s)" % (idx + 1, result["output"], result["time"]))
+            yield idx, True, result
+        return
+
+    while queue:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+        pending = {}
+        in_use = 0
+        broken = False
+        try:
+            while queue or pending:
+                for idx in list(queue):
+                    if len(pending) >= n_workers:
+                        break
+                    if pending and budget is not None and in_use + estimates[idx] > budget:
+                        continue
+                    queue.remove(idx)
+                    pending[executor.submit(run_case, cases[idx], options)] = idx
+                    in_use += estimates[idx]
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    idx = pending.pop(future)
+                    in_use -= estimates[idx]
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as exc:
+                        # A worker died (e.g. killed for using too much memory) and
+                        # the pool cannot be used again
+                        broken = True
+                        failure = _failed(idx, exc)
+                        if failure is not None:
+                            yield failure
+                        continue
+                    except Exception as exc:
+                        failure = _failed(idx, exc)
+                        if failure is not None:
+                            yield failure
+                        continue
+                    _log("Case %i done: %s (%.1f s)" % (idx + 1, result["output"], result["time"]))
+                    yield idx, True, result
+
+                if broken:
+                    for future, idx in pending.items():
+                        failure = _failed(idx, "worker pool stopped")
+                        if failure is not None:
+                            yield failure
+                    break
+        finally:
+            executor.shutdown(wait=not broken)
+
+def load_batch(fname):
+    """
+    Read a batch description from a YAML file
+
+    File names in cases, and the result cache directory, are relative to the
+    directory containing the YAML file
+
+    :return: Tuple of (cases, process options, runner options)
+    """
+    with open(fname) as yaml_file:
+        spec = yaml.safe_load(yaml_file)
+    if not spec or not spec.get("Cases", None):
+        raise QpException("No cases found in %s" % fname)
+
+    basedir = os.path.dirname(os.path.abspath(fname))
+    cases = []
+    for case in spec["Cases"]:
+        case = dict(case)
+        if "data" not in case or "output" not in case:
+            raise QpException("Each case must give data and output files")
+        for key in CASE_KEYS:
+            if case.get(key, None):
+                case[key] = os.path.join(basedir, case[key])
+        cases.append(case)
+
+    runner_options = {
+        "n_workers" : spec.get("n-workers", 1),
+        "max_memory" : spec.get("max-memory", None),
+        "retries" : spec.get("retries", 1),
+    }
+    summary_file = spec.get("summary-file", None)
+    if summary_file:
+        runner_options["summary_file"] = os.path.join(basedir, summary_file)
+    options = dict(spec.get("Supervoxels", None) or {})
+    if options.get("cache-dir", None):
+        options["cache-dir"] = os.path.join(basedir, options["cache-dir"])
+    return cases, options, runner_options
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        sys.stderr.write("Usage: python -m quantiphyse_sv.batch <batch.yaml>\n")
+        return 1
+
+    cases, options, runner_options = load_batch(argv[0])
+    summary_file = runner_options.pop("summary_file", None)
+    summary, writer = None, None
+    if summary_file:
+        summary = open(summary_file, "w")
+        writer = csv.writer(summary)
+        writer.writerow(["case", "data", "output", "status", "n_supervoxels", "time"])
+
+    n_failed = 0
+    try:
+        for idx, success, result in run_batch(cases, options, log=sys.stdout, **runner_options):
+            n_failed += int(not success)
+            if writer is not None:
+                if success:
+                    writer.writerow([idx + 1, cases[idx]["data"], result["output"], "OK",
+                                     result["n_supervoxels"], round(result["time"], 3)])
+                else:
+                    writer.writerow([idx + 1, cases[idx]["data"], cases[idx]["output"], "FAILED", "", ""])
+                summary.flush()
+    finally:
+        if summary is not None:
+            summary.close()
+
+    sys.stdout.write("%i cases done, %i failed\n" % (len(cases) - n_failed, n_failed))
+    return int(n_failed > 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
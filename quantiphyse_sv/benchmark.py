@@ -0,0 +1,414 @@
+"""
+Quantiphyse - Benchmarks for supervoxel generation
+
+Runs the Supervoxels process on synthetic 3D and 4D volumes of increasing
+size and ROI fill fraction, and saves the run times and peak memory use to a
+JSON file which can be compared with the results from another version::
+
+    python -m quantiphyse_sv.benchmark --output results.json
+    python -m quantiphyse_sv.benchmark --output new.json --compare results.json
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+from quantiphyse.utils import get_version
+
+from .process import run_supervoxels
+
+#: Default benchmark cases, small enough to run in a few minutes
+DEFAULT_SIZES = (64, 128)
+DEFAULT_NVOLS = (1, 20)
+DEFAULT_FILLS = (0.1, 0.5)
+DEFAULT_N_SUPERVOXELS = (50, 500)
+DEFAULT_N_COMPONENTS = (3,)
+
+#: Full set of cases, skipping those which do not fit in the memory limit
+FULL_SIZES = (64, 128, 256, 512)
+FULL_NVOLS = (1, 20, 200)
+
+def synthetic_data(size, nvols, fill, n_classes=4, noise=0.1, seed=0):
+    """
+    Generate a synthetic volume of blocky tissue classes within a spherical ROI
+
+    For 4D data each class has its own bolus-shaped timecourse.
+
+    :param size: Number of voxels along each axis
+    :param nvols: Number of timepoints, 1 for 3D data
+    :param fill: Fraction of the volume covered by the ROI
+    :param n_classes: Number of distinct tissue classes
+    :param noise: Standard deviation of added Gaussian noise
+    :param seed: Random seed
+    :return: Tuple of (float32 image data, integer mask)
+    """
+    rng = np.random.RandomState(seed)
+    axis = (np.arange(size, dtype=np.float32) + 0.5) / size
+    x, y, z = axis[:, None, None], axis[None, :, None], axis[None, None, :]
+
+    block = max(1, size // 8)
+    classes = ((np.arange(size) // block)[:, None, None] + 2 * (np.arange(size) // block)[None, :, None]
+               + 3 * (np.arange(size) // block)[None, None, :]) % n_classes
+
+    dist = (x - 0.5)**2 + (y - 0.5)**2 + (z - 0.5)**2
+    mask = (dist <= np.percentile(dist, 100 * fill)).astype(np.int8)
+
+    if nvols > 1:
+        times = np.linspace(0, 1, nvols, dtype=np.float32)
+        curves = np.zeros((n_classes, nvols), dtype=np.float32)
+        for idx in range(n_classes):
+            delay = 0.1 + 0.1 * idx
+            rise = np.clip(times - delay, 0, None)
+            curves[idx] = (1 + idx) * rise * np.exp(-rise / (0.05 + 0.05 * idx))
+        curves /= curves.max()
+        img = curves[classes]
+    else:
+        img = np.linspace(0, 1, n_classes, dtype=np.float32)[classes]
+    img += rng.normal(scale=noise, size=img.shape).astype(np.float32)
+    return img, mask
+
+def input_size_mb(size, nvols):
+    """
+    :return: Size of the synthetic input data in Mb
+    """
+    return float(size**3 * nvols * 4) / (1024 * 1024)
+
+def _case_ivm(size, nvols, fill):
+    """
+    :return: ImageVolumeManagement containing synthetic ``data`` and ``mask``
+    """
+    img, mask = synthetic_data(size, nvols, fill)
+    ivm = ImageVolumeManagement()
+    grid = DataGrid(img.shape[:3], np.identity(4))
+    ivm.add(NumpyData(img, grid=grid, name="data"))
+    ivm.add(NumpyData(mask, grid=grid, name="mask", roi=True))
+    return ivm
+
+def _peak_memory(rows):
+    """
+    :param rows: Stage rows from ``StageProfiler.rows``
+    :return: Largest stage peak memory in Mb, or None if no stage measured it
+    """
+    peaks = [row[2] for row in rows if isinstance(row[2], (int, float))]
+    return max(peaks) if peaks else None
+
+def run_case(size, nvols, fill, n_supervoxels, n_components, repeats=1, memory=True, **options):
+    """
+    Benchmark the Supervoxels process on a single synthetic data set
+
+    Run times are the best of ``repeats`` runs without memory tracing. If
+    ``memory`` is True a further run is made with profiling enabled to
+    measure the time and peak memory of each stage.
+
+    :param options: Additional process options
+    :return: Dictionary of case parameters and results
+    """
+    ivm = _case_ivm(size, nvols, fill)
+    run_options = dict(options, data="data", roi="mask", **{
+        "n-supervoxels" : n_supervoxels,
+        "n-components" : n_components,
+        "output-name" : "sv",
+    })
+
+    times = []
+    for _ in range(max(1, repeats)):
+        start = time.time()
+        run_supervoxels(ivm, dict(run_options))
+        times.append(time.time() - start)
+
+    result = {
+        "size" : size,
+        "nvols" : nvols,
+        "fill" : fill,
+        "n_supervoxels" : n_supervoxels,
+        "n_components" : n_components,
+        "options" : options,
+        "time" : min(times),
+        "n_output" : len(ivm.rois["sv"].regions),
+    }
+
+    if memory:
+        run_supervoxels(ivm, dict(run_options, profile=True))
+        stages = ivm.extras["sv_profile"].arr
+        result["stages"] = [{"stage" : row[0], "time" : row[1], "peak_memory" : row[2] if row[2] != "" else None}
+                            for row in stages]
+        # Stage peaks are relative to the memory in use when each stage starts
+        result["peak_memory"] = _peak_memory(stages)
+    return result
+
+def label_agreement(labels, reference):
+    """
+    Agreement between two supervoxel outputs for the same data
+
+    :param labels: Supervoxel ROI values, 0 outside the ROI
+    :param reference: Reference supervoxel ROI values
+    :return: Tuple of (fraction of ROI voxels with the same value, fraction
+             of ROI voxels which lie in the overlap between their supervoxel
+             and its best matching reference supervoxel). The second is not
+             affected by supervoxels being numbered differently
+    """
+    inside = (labels > 0) | (reference > 0)
+    labels, reference = labels[inside].astype(np.int64), reference[inside].astype(np.int64)
+    if not labels.size:
+        return 1.0, 1.0
+    same = float(np.count_nonzero(labels == reference)) / labels.size
+    n_ref = int(reference.max()) + 1
+    pairs, counts = np.unique(labels * n_ref + reference, return_counts=True)
+    best = np.zeros(int(labels.max()) + 1, dtype=np.int64)
+    np.maximum.at(best, pairs // n_ref, counts)
+    return same, float(best.sum()) / labels.size
+
+def precision_report(size, nvols, fill, n_supervoxels, n_components, memory=True, **options):
+    """
+    Compare supervoxels generated with single and double precision data
+
+    The process is run with ``precision`` set to ``float64``, which is the
+    type of data loaded from NIfTI files, and to ``float32``.
+
+    :param options: Additional process options
+    :return: Dictionary of case parameters, the time and (if ``memory`` is
+             True) peak memory for each precision, and the label agreement
+             from ``label_agreement``
+    """
+    ivm = _case_ivm(size, nvols, fill)
+    result = {
+        "size" : size,
+        "nvols" : nvols,
+        "fill" : fill,
+        "n_supervoxels" : n_supervoxels,
+        "n_components" : n_components,
+        "options" : options,
+    }
+    for precision in ("float64", "float32"):
+        run_options = dict(options, data="data", roi="mask", precision=precision, **{
+            "n-supervoxels" : n_supervoxels,
+            "n-components" : n_components,
+            "output-name" : precision,
+        })
+        start = time.time()
+        run_supervoxels(ivm, dict(run_options))
+        result[precision] = {"time" : time.time() - start}
+        if memory:
+            run_supervoxels(ivm, dict(run_options, profile=True))
+            result[precision]["peak_memory"] = _peak_memory(ivm.extras[precision + "_profile"].arr)
+
+    same, matched = label_agreement(ivm.rois["float32"].raw(), ivm.rois["float64"].raw())
+    result["same_label"], result["matched"] = same, matched
+    return result
+
+def _describe_precision(result):
+    desc = "size=%i nvols=%i fill=%.2f n-supervoxels=%i n-components=%i: " % (
+        result["size"], result["nvols"], result["fill"], result["n_supervoxels"], result["n_components"])
+    for precision in ("float64", "float32"):
+        desc += "%s %.3f s" % (precision, result[precision]["time"])
+        if result[precision].get("peak_memory", None) is not None:
+            desc += " %.1f Mb" % result[precision]["peak_memory"]
+        desc += ", "
+    return desc + "same label %.4f, matched %.4f" % (result["same_label"], result["matched"])
+
+def thread_scaling(size, nvols, fill, n_supervoxels, n_components, threads=(1, 2, 4), repeats=1, **options):
+    """
+    Measure how the run time of the threaded NumPy engine scales with the number of threads
+
+    The default maskslic engine, which clusters on a single thread, is timed
+    on the same case for comparison. Only the assignment step of the NumPy
+    engine is threaded, so it may not be faster than maskslic with any
+    number of threads.
+
+    :param threads: Numbers of threads to time the NumPy engine with
+    :param options: Additional process options
+    :return: Dictionary of case parameters, the maskslic time and a list of
+             [threads, time] pairs for the NumPy engine
+    """
+    result = {
+        "size" : size,
+        "nvols" : nvols,
+        "fill" : fill,
+        "n_supervoxels" : n_supervoxels,
+        "n_components" : n_components,
+        "options" : options,
+    }
+    case = (size, nvols, fill, n_supervoxels, n_components)
+    result["maskslic"] = run_case(*case, repeats=repeats, memory=False, **options)["time"]
+    result["numpy"] = [[n, run_case(*case, repeats=repeats, memory=False, engine="numpy", threads=n,
+                                    **options)["time"]]
+                       for n in threads]
+    return result
+
+def _describe_scaling(result):
+    desc = "size=%i nvols=%i fill=%.2f n-supervoxels=%i n-components=%i: maskslic %.3f s" % (
+        result["size"], result["nvols"], result["fill"], result["n_supervoxels"], result["n_components"],
+        result["maskslic"])
+    for threads, elapsed in result["numpy"]:
+        desc += ", numpy %i threads %.3f s" % (threads, elapsed)
+    return desc
+
+def benchmark_cases(sizes=DEFAULT_SIZES, nvols=DEFAULT_NVOLS, fills=DEFAULT_FILLS,
+                    n_supervoxels=DEFAULT_N_SUPERVOXELS, n_components=DEFAULT_N_COMPONENTS,
+                    max_memory=4096):
+    """
+    Generate the combinations of benchmark parameters to run
+
+    The number of PCA components only affects 4D data, so 3D cases are only
+    run with the first value. Cases whose input data alone would exceed
+    ``max_memory`` Mb are left out.
+
+    :return: List of (size, nvols, fill, n_supervoxels, n_components) tuples
+    """
+    cases = []
+    for size, n, fill, n_sv, ncomp in itertools.product(sizes, nvols, fills, n_supervoxels, n_components):
+        if n == 1 and ncomp != n_components[0]:
+            continue
+        if input_size_mb(size, n) > max_memory:
+            continue
+        cases.append((size, n, fill, n_sv, ncomp))
+    return cases
+
+def run_benchmarks(cases, repeats=1, memory=True, options=None, log=None):
+    """
+    Run a set of benchmark cases
+
+    :param cases: Sequence of case parameters from ``benchmark_cases``
+    :param log: Optional file-like object to write progress to
+    :return: Dictionary of environment information and results
+    """
+    results = []
+    for case in cases:
+        result = run_case(*case, repeats=repeats, memory=memory, **(options or {}))
+        if log is not None:
+            log.write("%s\n" % _describe(result))
+            log.flush()
+        results.append(result)
+
+    return {
+        "quantiphyse" : get_version(),
+        "python" : platform.python_version(),
+        "numpy" : np.__version__,
+        "platform" : platform.platform(),
+        "date" : time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results" : results,
+    }
+
+def _case_key(result):
+    return (result["size"], result["nvols"], result["fill"], result["n_supervoxels"],
+            result["n_components"], json.dumps(result["options"], sort_keys=True))
+
+def _describe(result):
+    desc = "size=%i nvols=%i fill=%.2f n-supervoxels=%i n-components=%i: %.3f s" % (
+        result["size"], result["nvols"], result["fill"], result["n_supervoxels"],
+        result["n_components"], result["time"])
+    if result.get("peak_memory", None) is not None:
+        desc += ", peak memory %.1f Mb" % result["peak_memory"]
+    return desc
+
+def compare(baseline, current):
+    """
+    Compare two sets of benchmark results
+
+    :param baseline: Results dictionary from ``run_benchmarks``
+    :param current: Results dictionary from ``run_benchmarks``
+    :return: List of (description, time ratio, peak memory ratio) for each case
+             present in both. Ratios are current / baseline and the memory
+             ratio is None if either run did not measure memory
+    """
+    baseline_results = dict((_case_key(result), result) for result in baseline["results"])
+    ratios = []
+    for result in current["results"]:
+        old = baseline_results.get(_case_key(result), None)
+        if old is None:
+            continue
+        mem_ratio = None
+        if old.get("peak_memory", None) and result.get("peak_memory", None):
+            mem_ratio = result["peak_memory"] / old["peak_memory"]
+        ratios.append((_describe(result), result["time"] / max(old["time"], 1e-6), mem_ratio))
+    return ratios
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Benchmark supervoxel generation")
+    parser.add_argument("--output", help="JSON file to save results to")
+    parser.add_argument("--compare", help="JSON file of baseline results to compare with")
+    parser.add_argument("--full", action="store_true", help="Run the full set of sizes and timepoints")
+    parser.add_argument("--sizes", type=int, nargs="+", help="Volume sizes along each axis")
+    parser.add_argument("--nvols", type=int, nargs="+", help="Numbers of timepoints")
+    parser.add_argument("--fills", type=float, nargs="+", default=DEFAULT_FILLS, help="ROI fill fractions")
+    parser.add_argument("--n-supervoxels", type=int, nargs="+", default=DEFAULT_N_SUPERVOXELS)
+    parser.add_argument("--n-components", type=int, nargs="+", default=DEFAULT_N_COMPONENTS)
+    parser.add_argument("--max-memory", type=float, default=4096,
+                        help="Skip cases whose input data is larger than this (Mb)")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of timed runs per case")
+    parser.add_argument("--no-memory", action="store_true", help="Do not measure peak memory")
+    parser.add_argument("--options", default="{}", help="Additional process options as JSON")
+    parser.add_argument("--precision-report", action="store_true",
+                        help="Compare labels, time and memory for float64 and float32 precision")
+    parser.add_argument("--thread-scaling", action="store_true",
+                        help="Time the numpy engine with each number of threads against maskslic")
+    parser.add_argument("--threads", type=int, nargs="+", default=(1, 2, 4),
+                        help="Numbers of threads for --thread-scaling")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (FULL_SIZES if args.full else DEFAULT_SIZES)
+    nvols = args.nvols or (FULL_NVOLS if args.full else DEFAULT_NVOLS)
+    cases = benchmark_cases(sizes, nvols, args.fills, args.n_supervoxels, args.n_components,
+                            args.max_memory)
+    if args.precision_report:
+        results = []
+        for case in cases:
+            results.append(precision_report(*case, memory=not args.no_memory, **json.loads(args.options)))
+            print(_describe_precision(results[-1]))
+        if args.output:
+            with open(args.output, "w") as json_file:
+                json.dump({"results" : results}, json_file, indent=2)
+        return
+
+    if args.thread_scaling:
+        results = []
+        for case in cases:
+            results.append(thread_scaling(*case, threads=args.threads, repeats=args.repeats,
+                                          **json.loads(args.options)))
+            print(_describe_scaling(results[-1]))
+        if args.output:
+            with open(args.output, "w") as json_file:
+                json.dump({"results" : results}, json_file, indent=2)
+        return
+
+    report = run_benchmarks(cases, args.repeats, not args.no_memory, json.loads(args.options),
+                            log=sys.stdout)
+
+    if args.output:
+        with open(args.output, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as json_file:
+            baseline = json.load(json_file)
+        for desc, time_ratio, mem_ratio in compare(baseline, report):
+            line = "%s: time x%.2f" % (desc, time_ratio)
+            if mem_ratio is not None:
+                line += ", memory x%.2f" % mem_ratio
+            print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Quantiphyse - Caching of supervoxel preprocessing and results
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+class FeatureCache(object):
+    """
+    In-memory LRU cache of preprocessed feature volumes
+
+    Entries are tied to the data object they were computed from, so replacing
+    a data set in the IVM (even under the same name) never returns stale
+    features. The least recently used entries are evicted to keep the total
+    size of the cached arrays within a memory budget.
+
+    Features computed from several data sets use a tuple of all of them as
+    the source, and are only returned while none has been replaced.
+
+    The cache may be used from more than one thread, so all access is
+    serialised by a lock. Background workers do not use it directly: the
+    process looks features up before starting the worker and adds the
+    features it computed when it finishes.
+    """
+    def __init__(self, max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+
+    def get(self, key, source):
+        """
+        :param key: Hashable key describing the preprocessing inputs
+        :param source: Object, or tuple of objects, the features were computed from
+        :return: Cached features, or None if there is no valid entry
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return None
+            sources = source if isinstance(source, tuple) else (source,)
+            if len(entry[0]) != len(sources) or any(ref() is not obj for ref, obj in zip(entry[0], sources)):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, source, features):
+        """
+        Add features to the cache, evicting old entries if required
+
+        Arrays larger than the whole budget are not cached.
+        """
+        sources = source if isinstance(source, tuple) else (source,)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if features.nbytes > self.max_bytes:
+                return
+            self._entries[key] = (tuple(weakref.ref(obj) for obj in sources), features)
+            self.nbytes += features.nbytes
+            self._evict()
+
+    def set_budget(self, max_bytes):
+        """
+        Change the memory budget, evicting entries if required
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _evict(self):
+        # Called with the lock held
+        while self.nbytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, features = self._entries.pop(key)
+        self.nbytes -= features.nbytes
+
+#: Shared cache used by all instances of the Supervoxels process
+FEATURE_CACHE = FeatureCache()
+
+def content_hash(arrays, options):
+    """
+    Hash of a set of arrays and options, used as a result cache key
+
+    4D arrays are hashed one volume at a time so memory mapped data is not
+    loaded in full.
+
+    :param arrays: Sequence of array-like objects supporting ``shape`` and slicing
+    :param options: JSON serialisable dictionary of options
+    :return: Hex digest string
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    for arr in arrays:
+        digest.update(str(tuple(arr.shape)).encode("utf-8"))
+        volumes = [arr[:, :, :, vol] for vol in range(arr.shape[3])] if len(arr.shape) > 3 else [arr]
+        for vol in volumes:
+            vol = np.ascontiguousarray(vol)
+            digest.update(vol.dtype.str.encode("utf-8"))
+            digest.update(vol.view(np.uint8).ravel())
+    return digest.hexdigest()
+
+class ResultCache(object):
+    """
+    On-disk cache of supervoxel label volumes
+
+    Each result is a compressed ``.npz`` file named by its key. Loading a
+    result updates the file's modification time, and the least recently
+    used files are deleted to keep the total size within a limit. Files
+    are written under a temporary name and then renamed, so several
+    processes can share a cache directory.
+    """
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _fname(self, key):
+        return os.path.join(self.directory, "%s.npz" % key)
+
+    def get(self, key):
+        """
+        :return: Cached labels, or None if there is no entry for the key
+        """
+        fname = self._fname(key)
+        try:
+            with np.load(fname) as arrays:
+                labels = arrays["labels"]
+            os.utime(fname, None)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return labels
+
+    def put(self, key, labels):
+        """
+        Add labels to the cache, evicting old entries if required
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        handle, tempname = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as tempfile_obj:
+                np.savez_compressed(tempfile_obj, labels=labels)
+            os.replace(tempname, self._fname(key))
+        except Exception:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is within its size limit
+        """
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith(".npz"):
+                path = os.path.join(self.directory, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
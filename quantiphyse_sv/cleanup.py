@@ -0,0 +1,200 @@
+"""
+Quantiphyse - Connectivity cleanup and relabelling of supervoxel label volumes
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+
+from .adjacency import adjacent_pairs
+
+#: Rough memory per voxel of a slab for the connectivity graph, in bytes
+BYTES_PER_VOXEL = 64
+
+def _shifted(arr, axis):
+    """
+    :return: Views of an array without its last and first planes along an axis
+    """
+    first = tuple(slice(None, -1) if dim == axis else slice(None) for dim in range(arr.ndim))
+    second = tuple(slice(1, None) if dim == axis else slice(None) for dim in range(arr.ndim))
+    return arr[first], arr[second]
+
+def _merge(n_nodes, first, second):
+    """
+    Vectorised union-find: connected components of a graph given as edge lists
+
+    :return: Component index for each node
+    """
+    graph = scipy.sparse.coo_matrix((np.ones(len(first), dtype=np.int8), (first, second)),
+                                    shape=(n_nodes, n_nodes))
+    return connected_components(graph, directed=False)[1]
+
+def slab_thickness(shape, max_memory):
+    """
+    :param shape: Shape of the label volume
+    :param max_memory: Memory budget in Mb
+    :return: Number of planes along the first axis to process at a time
+    """
+    plane = int(np.prod(shape[1:]))
+    return int(max(1, (max_memory * 1024 * 1024) // max(1, plane * BYTES_PER_VOXEL)))
+
+def connected_fragments(labels, thickness):
+    """
+    Split each supervoxel into its connected (6-neighbour) fragments
+
+    Fragments are found separately in slabs along the first axis, and
+    fragments which continue across slab boundaries are then joined, so
+    only one slab's worth of graph structure is held at a time. The
+    fragment index itself covers the whole volume.
+
+    :param labels: Cropped labels, -1 outside the mask
+    :param thickness: Number of planes per slab
+    :return: Tuple of (int32 fragment index for each voxel, -1 outside the mask,
+             number of fragments)
+    """
+    fragments = -np.ones(labels.shape, dtype=np.int32)
+    n_fragments = 0
+    for start in range(0, labels.shape[0], thickness):
+        slab = labels[start:start + thickness]
+        inside = slab >= 0
+        index = -np.ones(slab.shape, dtype=np.int64)
+        index[inside] = np.arange(np.count_nonzero(inside))
+        first, second = [], []
+        for axis in range(slab.ndim):
+            (label_a, label_b), (index_a, index_b) = _shifted(slab, axis), _shifted(index, axis)
+            same = (label_a == label_b) & (label_a >= 0)
+            first.append(index_a[same])
+            second.append(index_b[same])
+        comp = _merge(np.count_nonzero(inside), np.concatenate(first), np.concatenate(second))
+        fragments[start:start + thickness][inside] = comp + n_fragments
+        n_fragments += int(comp.max()) + 1 if comp.size else 0
+
+    # Join fragments which touch across slab boundaries
+    first, second = [], []
+    for start in range(thickness, labels.shape[0], thickness):
+        same = (labels[start - 1] == labels[start]) & (labels[start] >= 0)
+        first.append(fragments[start - 1][same])
+        second.append(fragments[start][same])
+    if first:
+        root = _merge(n_fragments, np.concatenate(first), np.concatenate(second))
+        _, root = np.unique(root, return_inverse=True)
+        inside = fragments >= 0
+        fragments[inside] = root[fragments[inside]]
+        n_fragments = int(root.max()) + 1 if root.size else 0
+    return fragments, n_fragments
+
+def _fragment_pairs(fragments, thickness):
+    """
+    Adjacent fragment pairs and shared boundary sizes, computed slab by slab
+    """
+    keys, counts = [], []
+    n_keys = max(int(fragments.max()) + 1, 1)
+    for start in range(0, fragments.shape[0], thickness):
+        pairs, boundary = adjacent_pairs(fragments[start:start + thickness])
+        keys.append(pairs[:, 0] * n_keys + pairs[:, 1])
+        counts.append(boundary)
+        stop = start + thickness
+        if stop < fragments.shape[0]:
+            # Faces between the last plane of this slab and the first plane of the
+            # next, removing the faces within each plane which are counted already
+            pairs, boundary = adjacent_pairs(fragments[stop - 1:stop + 1])
+            in_plane = [adjacent_pairs(fragments[plane:plane + 1]) for plane in (stop - 1, stop)]
+            keys += [pairs[:, 0] * n_keys + pairs[:, 1]] + [p[:, 0] * n_keys + p[:, 1] for p, _ in in_plane]
+            counts += [boundary] + [-c for _, c in in_plane]
+
+    keys, idx = np.unique(np.concatenate(keys), return_inverse=True)
+    totals = np.bincount(idx, weights=np.concatenate(counts)).astype(np.int64)
+    keep = totals > 0
+    return np.stack([keys[keep] // n_keys, keys[keep] % n_keys], axis=1), totals[keep]
+
+def cleanup_labels(labels, min_size, max_memory=512):
+    """
+    Enforce supervoxel connectivity, merge small supervoxels and relabel
+
+    Every connected fragment of a supervoxel other than its largest becomes
+    a separate region, and any region smaller than ``min_size`` voxels is
+    merged into the neighbour it shares the largest boundary with. Regions
+    with no neighbours are kept whatever their size. The result is
+    relabelled to the contiguous range ``0..N-1``.
+
+    This works in memory on the whole cropped volume: the fragment index,
+    the output and a mask are held for every voxel, about 9 bytes per voxel
+    besides the labels. Only the connectivity graphs, which are much larger
+    per voxel, are built a slab at a time.
+
+    :param labels: Cropped labels, -1 outside the mask
+    :param min_size: Minimum supervoxel size in voxels
+    :param max_memory: Memory budget for the graph of each slab in Mb
+    :return: Tuple of (cleaned labels, number of fragments merged)
+    """
+    labels = np.asarray(labels)
+    if not np.any(labels >= 0):
+        return labels, 0
+    thickness = slab_thickness(labels.shape, max_memory)
+    fragments, n_fragments = connected_fragments(labels, thickness)
+    inside = fragments >= 0
+    fragment_sizes = np.bincount(fragments[inside], minlength=n_fragments)
+
+    pairs, boundary = _fragment_pairs(fragments, thickness)
+    # Each fragment is mapped to a representative fragment of the region it
+    # has been merged into
+    target = np.arange(n_fragments)
+    sizes = fragment_sizes
+    n_merged = 0
+    while True:
+        # Each small region joins the neighbour it shares most boundary with. Merged
+        # regions may still be small, so repeat until nothing changes
+        region_pairs = target[pairs]
+        between = region_pairs[:, 0] != region_pairs[:, 1]
+        region_pairs, region_boundary = region_pairs[between], boundary[between]
+        src = np.concatenate([region_pairs[:, 0], region_pairs[:, 1]])
+        dst = np.concatenate([region_pairs[:, 1], region_pairs[:, 0]])
+        weight = np.concatenate([region_boundary, region_boundary])
+        candidate = sizes[src] < min_size
+        if not np.any(candidate):
+            break
+        src, dst, weight = src[candidate], dst[candidate], weight[candidate]
+
+        # Boundaries between the same two regions may come from several fragment pairs
+        keys, idx = np.unique(src * n_fragments + dst, return_inverse=True)
+        weight = np.bincount(idx, weights=weight)
+        src, dst = keys // n_fragments, keys % n_fragments
+
+        # Largest boundary for each source, ties broken by the larger neighbour
+        order = np.lexsort((-sizes[dst], -weight, src))
+        src, dst = src[order], dst[order]
+        first = np.concatenate([[True], src[1:] != src[:-1]])
+        src, dst = src[first], dst[first]
+
+        target = _representative(_merge(n_fragments, src, dst), target)
+        sizes = np.bincount(target, weights=fragment_sizes, minlength=n_fragments)
+        n_merged += len(src)
+
+    out = -np.ones(labels.shape, dtype=np.int32)
+    _, relabelled = np.unique(target[fragments[inside]], return_inverse=True)
+    out[inside] = relabelled
+    return out, n_merged
+
+def _representative(root, target):
+    """
+    Map each fragment to a single representative fragment of its merged region
+    """
+    merged = root[target]
+    _, first = np.unique(merged, return_index=True)
+    rep = np.empty(int(merged.max()) + 1, dtype=np.int64)
+    rep[merged[first]] = target[first]
+    return rep[merged]
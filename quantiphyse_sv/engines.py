@@ -0,0 +1,67 @@
+"""
+Quantiphyse - Registry of supervoxel clustering engines
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+
+from quantiphyse.utils import QpException
+
+from .parallel import perfslic_job, slic_features_job
+from .numpyslic import numpy_perfslic_job, numpy_slic_job
+
+#: Default engine, which uses maskslic's compiled SLIC iterations
+DEFAULT_ENGINE = "maskslic"
+
+#: A registered engine. ``threaded`` engines accept a ``threads`` keyword argument
+Engine = collections.namedtuple("Engine", ["image_job", "features_job", "threaded"])
+
+_ENGINES = {}
+
+def register_engine(name, image_job, features_job, threaded=False):
+    """
+    Make a clustering engine available to the ``engine`` option
+
+    Both jobs take the arguments ``(img, mask, n_supervoxels, slic_kwargs)``
+    and return labels which are -1 outside the mask. They must be top-level
+    functions so they can be run in a process pool.
+
+    :param name: Engine name
+    :param image_job: Job which clusters cropped 3D or 4D image data, doing
+                      the same preprocessing as ``maskslic.perfslic``
+    :param features_job: Job which clusters a precomputed feature volume
+    :param threaded: If True, the jobs accept a ``threads`` option in their
+                     keyword arguments
+    """
+    _ENGINES[name] = Engine(image_job, features_job, threaded)
+
+def get_engine(name):
+    """
+    :return: ``Engine`` tuple for a registered engine
+    """
+    if name not in _ENGINES:
+        raise QpException("Unknown clustering engine: %s (available: %s)"
+                          % (name, ", ".join(engine_names())))
+    return _ENGINES[name]
+
+def engine_names():
+    """
+    :return: Sorted list of registered engine names
+    """
+    return sorted(_ENGINES)
+
+register_engine("maskslic", perfslic_job, slic_features_job)
+register_engine("numpy", numpy_perfslic_job, numpy_slic_job, threaded=True)
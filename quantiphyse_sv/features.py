@@ -0,0 +1,305 @@
+"""
+Quantiphyse - Feature extraction for supervoxel clustering
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, gaussian_filter1d, uniform_filter1d
+from maskslic.perfslic import preprocess_pca
+
+from quantiphyse.utils import QpException
+
+# Temporal smoothing applied to each timeseries before PCA, as in perfslic
+PCA_SMOOTHING = 2.0
+
+# Held while NumPy's global generator is seeded by ``seeded``
+_SEED_LOCK = threading.Lock()
+
+#: Methods for ``smooth_features``
+SMOOTHING_METHODS = ("gaussian", "box")
+
+#: Number of box filter passes used to approximate a Gaussian
+BOX_PASSES = 3
+
+#: Narrower kernels (in voxels) use the Gaussian filter, which is faster for them. On a
+#: 128x128x128 volume the box filters take about 0.07 s for any sigma, which the Gaussian
+#: filter only reaches at a sigma of about 5 voxels
+BOX_MIN_SIGMA = 5.0
+
+def slabs(shape, batch):
+    """
+    Generate slices splitting a 3D box into slabs along the last axis
+
+    :param shape: 3D shape
+    :param batch: Number of slices in each slab
+    """
+    batch = max(1, int(batch))
+    for start in range(0, shape[2], batch):
+        yield (slice(None), slice(None), slice(start, min(start + batch, shape[2])))
+
+def streaming_pca(img, n_components, batch=8, timeseries=True):
+    """
+    Reduce a 4D timeseries to its principal components one slab at a time
+
+    This follows the same steps as ``maskslic.perfslic``: each voxel
+    timeseries has its baseline (mean of the first 3 volumes) subtracted and
+    is smoothed in time, the PCA is fitted over every voxel in the cropped
+    box and each component is scaled to the range 0-1. The difference is
+    that the timepoint covariance is accumulated over slabs of ``batch``
+    slices, so only one slab of the timeseries is held in memory at once
+    (``img`` may be a memory map) and only the reduced features are stored.
+
+    perfslic also divides the data by its 90th percentile before the PCA.
+    This only changes the overall scale, which is removed by the final
+    normalisation, so it is skipped here.
+
+    float32 data is processed in single precision. Other types are
+    converted to double precision one slab at a time. The covariance is
+    always accumulated in double precision.
+
+    :param img: 4D image data, already cropped to the mask bounding box
+    :param n_components: Number of components to keep
+    :param batch: Number of slices per slab
+    :param timeseries: If False the channels are not a timeseries, so the
+                       baseline subtraction and temporal smoothing are skipped
+    :return: float32 feature volume with ``n_components`` channels
+    """
+    shape, nvols = img.shape[:3], img.shape[3]
+    n_components = min(int(n_components), nvols)
+    dtype = np.float32 if getattr(img, "dtype", None) == np.float32 else np.float64
+
+    def _timeseries(slab):
+        # Always a copy, as it is modified in place
+        x = np.array(img[slab], dtype=dtype).reshape(-1, nvols)
+        if not timeseries:
+            return x
+        x -= np.mean(x[:, :3], axis=1, keepdims=True)
+        return gaussian_filter1d(x, sigma=PCA_SMOOTHING, axis=-1)
+
+    # Accumulate moments about a pilot mean from the first slab to limit
+    # cancellation error in the covariance
+    shift, count = None, 0
+    total, cross = np.zeros(nvols), np.zeros((nvols, nvols))
+    for slab in slabs(shape, batch):
+        x = _timeseries(slab)
+        if shift is None:
+            shift = np.mean(x, axis=0)
+        x -= shift
+        count += x.shape[0]
+        total += np.sum(x, axis=0)
+        cross += np.dot(x.T, x)
+
+    mean = total / count
+    cov = cross / count - np.outer(mean, mean)
+    evals, evecs = np.linalg.eigh(cov)
+    components = evecs[:, np.argsort(evals)[::-1][:n_components]].astype(dtype)
+    mean = (mean + shift).astype(dtype)
+
+    features = np.zeros(shape + (n_components,), dtype=np.float32)
+    for slab in slabs(shape, batch):
+        slab_shape = features[slab].shape
+        features[slab] = np.dot(_timeseries(slab) - mean, components).reshape(slab_shape)
+
+    for comp in range(n_components):
+        feature = features[..., comp]
+        feature -= feature.min()
+        feature /= feature.max() + 0.001
+    return features
+
+@contextlib.contextmanager
+def seeded(random_state):
+    """
+    Seed NumPy's global generator for a block, restoring its previous state afterwards
+
+    maskslic's PCA may use a randomized solver which draws from the global
+    generator and has no seed option of its own. Seeded blocks hold a lock,
+    so concurrent seeded blocks in other threads cannot change the
+    generator part way through.
+
+    :param random_state: Seed, or None to leave the global generator alone
+    """
+    if random_state is None:
+        yield
+        return
+    with _SEED_LOCK:
+        state = np.random.get_state()
+        np.random.seed(random_state)
+        try:
+            yield
+        finally:
+            np.random.set_state(state)
+
+def pca_features(img, n_components, random_state=None):
+    """
+    PCA feature volume for 4D data, computed by ``maskslic.perfslic``'s own preprocessing
+
+    :param img: 4D image data
+    :param n_components: Number of PCA components
+    :param random_state: Seed for the PCA, as for ``seeded``
+    :return: Feature volume with the PCA components along the last axis
+    """
+    with seeded(random_state):
+        return preprocess_pca(img, n_components)
+
+def intensity_features(img):
+    """
+    Single-channel features for 3D data, scaled to 0-1 as in perfslic
+
+    :param img: 3D image data, already cropped to the mask bounding box
+    :return: float32 feature volume with one channel
+    """
+    img = np.asarray(img, dtype=np.float32)
+    if img.ndim > 3:
+        img = np.squeeze(img, -1)
+    img = img - img.min()
+    img /= img.max()
+    return img[..., np.newaxis]
+
+def box_widths(sigma, passes=BOX_PASSES):
+    """
+    Widths of odd-sized box filters which together approximate a Gaussian
+
+    Two widths differing by 2 are mixed so that the total variance of the
+    passes is as close as possible to ``sigma**2`` (Kovesi, 2010).
+
+    :param sigma: Gaussian kernel width in voxels
+    :param passes: Number of box filter passes
+    :return: List of ``passes`` odd widths
+    """
+    ideal = np.sqrt(12 * sigma**2 / passes + 1)
+    lower = int(np.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    n_lower = int(round((12 * sigma**2 - passes * lower**2 - 4 * passes * lower - 3 * passes)
+                        / (-4.0 * lower - 4)))
+    n_lower = min(max(n_lower, 0), passes)
+    return [lower] * n_lower + [lower + 2] * (passes - n_lower)
+
+def _smooth_volume(vol, sigma, method):
+    """
+    Smooth a single 3D volume with per-axis sigma in voxels
+    """
+    if method == "gaussian":
+        return gaussian_filter(vol, list(sigma))
+    for axis, axis_sigma in enumerate(sigma):
+        if axis_sigma <= 0:
+            continue
+        if axis_sigma < BOX_MIN_SIGMA:
+            vol = gaussian_filter1d(vol, axis_sigma, axis=axis)
+        else:
+            for width in box_widths(axis_sigma):
+                vol = uniform_filter1d(vol, width, axis=axis)
+    return vol
+
+def modality_features(stack, n_components, batch=8):
+    """
+    Feature volume for a stack of normalised modalities from ``source.ModalityStack``
+
+    If there are no more channels than components they are used directly,
+    since the PCA would only rotate them. Otherwise they are reduced with the
+    streaming PCA, without the timeseries preprocessing.
+
+    :param stack: Cropped float32 4D stack
+    :param n_components: Number of PCA components to use
+    :param batch: Number of slices per slab for the streaming PCA
+    :return: float32 feature volume
+    """
+    if stack.shape[3] <= n_components:
+        return np.asarray(stack, dtype=np.float32)
+    return streaming_pca(stack, n_components, batch=batch, timeseries=False)
+
+def smooth_features(features, sigma, spacing, method="gaussian", threads=1):
+    """
+    Gaussian smoothing of a feature volume, matching the ``sigma`` option of ``maskslic.slic``
+
+    A scalar ``sigma`` is divided by the voxel spacing along each axis and
+    no smoothing is applied along the feature axis.
+
+    The ``gaussian`` method is the separable filter used by maskslic, whose
+    cost grows with the kernel width. The ``box`` method approximates it
+    with repeated running-sum box filters along each axis, whose cost does
+    not depend on sigma. It is only faster for wide kernels, so axes where
+    the kernel is narrower than ``BOX_MIN_SIGMA`` voxels still use the
+    Gaussian filter. Where the box filters are used the features, and so the
+    labels, differ slightly from Gaussian smoothing. Each channel is smoothed
+    separately, so channels can be processed in parallel.
+
+    :param features: Feature volume with channels along the last axis
+    :param sigma: Smoothing kernel width, scalar or per-axis
+    :param spacing: Voxel spacing
+    :param method: Smoothing method, one of ``SMOOTHING_METHODS``
+    :param threads: Number of channels to smooth in parallel
+    :return: Smoothed features, or the input unchanged if sigma is zero
+    """
+    if not isinstance(sigma, collections.abc.Iterable):
+        sigma = np.array([sigma, sigma, sigma], dtype=np.double) / np.asarray(spacing, dtype=np.double)
+    sigma = np.asarray(sigma, dtype=np.double)
+    if not (sigma > 0).any():
+        return features
+    if method not in SMOOTHING_METHODS:
+        raise QpException("Unknown smoothing method: %s" % method)
+    if method == "gaussian" and threads <= 1:
+        return gaussian_filter(features, list(sigma) + [0])
+
+    smoothed = np.empty_like(features)
+    channels = [features[..., chan] for chan in range(features.shape[-1])]
+    with ThreadPoolExecutor(max(1, min(int(threads), len(channels)))) as executor:
+        for chan, vol in enumerate(executor.map(lambda vol: _smooth_volume(vol, sigma, method), channels)):
+            smoothed[..., chan] = vol
+    return smoothed
+
+def extract_features(img, n_components, pca_batch=8, streaming=False, random_state=None):
+    """
+    Unsmoothed feature volume for 3D or 4D data
+
+    These are the features ``maskslic.perfslic`` clusters, so clustering them
+    gives the same labels as perfslic does. If ``streaming`` is True the PCA
+    of 4D data is done with ``streaming_pca`` instead, which holds less in
+    memory but does not give identical features.
+
+    :param img: 3D or 4D image data, already cropped to the mask bounding box
+    :param n_components: Number of PCA components to use for 4D data
+    :param pca_batch: Number of slices per slab for the streaming PCA
+    :param streaming: If True use the streaming PCA for 4D data
+    :param random_state: Seed for the PCA, as for ``seeded``
+    :return: Feature volume
+    """
+    if img.ndim > 3 and img.shape[3] > 1:
+        if streaming:
+            return streaming_pca(img, n_components, batch=pca_batch)
+        return pca_features(np.asarray(img), n_components, random_state)
+    return intensity_features(img)
+
+def preprocess(img, n_components, sigma, spacing, pca_batch=8, method="gaussian", threads=1):
+    """
+    Compute the smoothed feature volume which perfslic would pass to the SLIC iterations
+
+    :param img: 3D or 4D image data, already cropped to the mask bounding box
+    :param n_components: Number of PCA components to use for 4D data
+    :param sigma: Smoothing kernel width
+    :param spacing: Voxel spacing
+    :param pca_batch: Number of slices per slab for the streaming PCA
+    :param method: Smoothing method, one of ``SMOOTHING_METHODS``
+    :param threads: Number of channels to smooth in parallel
+    :return: float32 feature volume
+    """
+    features = extract_features(img, n_components, pca_batch)
+    return smooth_features(features, sigma, spacing, method, threads)
@@ -0,0 +1,100 @@
+"""
+Quantiphyse - Incremental supervoxel updates after ROI edits
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from scipy.ndimage import binary_dilation
+
+from .parallel import perfslic_job
+from .regions import region_bounding_box
+
+def _expand(slices, margin, shape):
+    return tuple(slice(max(0, s.start - margin), min(size, s.stop + margin))
+                 for s, size in zip(slices, shape))
+
+def affected_labels(previous, mask, margin=2):
+    """
+    Find the previous supervoxels which are touched by an ROI edit
+
+    :param previous: Previous supervoxel output values, 0 outside the old ROI
+    :param mask: Edited ROI on the same grid
+    :param margin: Supervoxels within this many voxels of a changed voxel are affected
+    :return: Tuple of (sorted array of affected labels, boolean array of changed voxels)
+             or (None, None) if the ROI has not changed
+    """
+    changed = (mask > 0) != (previous > 0)
+    if not np.any(changed):
+        return None, None
+
+    # Only dilate around the edit so the cost scales with its size
+    bbox = _expand(region_bounding_box(changed), margin, changed.shape)
+    near = changed[bbox]
+    if margin > 0:
+        near = binary_dilation(near, iterations=margin)
+    labels = np.unique(previous[bbox][near])
+    return labels[labels > 0], changed
+
+def incremental_slic(img, mask, previous, slic_kwargs, margin=2, slic_fn=perfslic_job):
+    """
+    Update a previous supervoxel output after the ROI has been edited
+
+    Supervoxels which touch the changed voxels (plus a margin) are removed
+    and their voxels, together with any voxels newly added to the ROI, are
+    clustered again. The number of new supervoxels keeps the previous mean
+    supervoxel size. All other supervoxels keep their previous labels, and
+    labels freed by the update are reused for the new supervoxels before
+    any new values.
+
+    :param img: Cropped 3D or 4D image data
+    :param mask: Cropped edited ROI
+    :param previous: Previous supervoxel output values on the same crop, 0 outside the old ROI
+    :param slic_kwargs: Keyword arguments for ``slic_fn``
+    :param margin: Margin around the changed voxels in voxels
+    :param slic_fn: Picklable job function used to cluster the updated region
+    :return: Tuple of (labels in the same convention as perfslic, i.e. -1 outside
+             the mask, number of supervoxels reclustered)
+    """
+    previous = np.asarray(previous).astype(np.int64)
+    inside = mask > 0
+    out = np.where(inside & (previous > 0), previous - 1, -1)
+
+    affected, changed = affected_labels(previous, mask, margin)
+    if changed is None:
+        return out, 0
+
+    redo = inside & ((previous == 0) | np.isin(previous, affected))
+    if not np.any(redo):
+        return out, 0
+
+    n_previous = np.count_nonzero(np.bincount(previous[previous > 0]))
+    mean_size = float(np.count_nonzero(previous)) / max(1, n_previous)
+    n_redo = np.count_nonzero(redo)
+    n_redo = int(min(n_redo, max(1, round(n_redo / max(mean_size, 1)))))
+
+    bbox = region_bounding_box(redo)
+    local_mask = redo[bbox]
+    labels = np.asarray(slic_fn(np.asarray(img[bbox]), local_mask, n_redo, slic_kwargs))
+    labels_inside = local_mask & (labels >= 0)
+    _, new_labels = np.unique(labels[labels_inside], return_inverse=True)
+    n_new = int(new_labels.max()) + 1 if new_labels.size else 0
+
+    # Output values are one more than the labels, so reuse freed values first
+    values = np.concatenate([affected, np.arange(n_new) + max(previous.max(), 0) + 1])[:n_new]
+    out_bbox = out[bbox]
+    out_bbox[local_mask] = -1
+    out_bbox[labels_inside] = values[new_labels] - 1
+    return out, n_new
@@ -0,0 +1,116 @@
+"""
+Quantiphyse - Helpers for assembling and storing supervoxel label volumes
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+from quantiphyse.data import NumpyData, DataGrid
+
+from .regions import region_bounding_box
+
+def label_dtype(max_label):
+    """
+    :return: Smallest unsigned integer dtype which can hold ``max_label``
+    """
+    return np.min_scalar_type(max(int(max_label), 0))
+
+def assemble_labels(labels, slices, shape):
+    """
+    Build the full-grid output ROI from cropped supervoxel labels
+
+    The labels use the perfslic convention of -1 outside the mask, and are
+    shifted so that supervoxels start at 1 and background is 0. They are
+    written straight into a preallocated array of the smallest suitable
+    integer type, so no full-grid temporary is created.
+
+    :param labels: Cropped label array
+    :param slices: Bounding box slices of the crop within the full grid
+    :param shape: Full grid shape
+    :return: Tuple of output array, number of bytes saved relative to the
+             float32 full-grid array which ``NumpyData`` used to store
+    """
+    labels = np.asarray(labels)
+    max_label = labels.max() + 1 if labels.size else 0
+    newroi = np.zeros(shape, dtype=label_dtype(max_label))
+    np.add(labels, 1, out=newroi[slices], casting="unsafe")
+
+    baseline = np.prod(shape) * np.dtype(np.float32).itemsize
+    return newroi, int(baseline - newroi.nbytes)
+
+def compact_labels(roi):
+    """
+    Crop a full-grid label volume to the bounding box of its non-zero voxels
+
+    :param roi: Full-grid label array, 0 for background
+    :return: Tuple of (offset of the box within the grid, cropped labels in the
+             smallest suitable integer type)
+    """
+    roi = np.asarray(roi)
+    if not np.any(roi):
+        return (0,) * roi.ndim, np.zeros((0,) * roi.ndim, dtype=np.uint8)
+    slices = region_bounding_box(roi != 0)
+    cropped = roi[slices]
+    return tuple(s.start for s in slices), cropped.astype(label_dtype(cropped.max()))
+
+def save_labels(fname, cropped, offset, shape, affine=None):
+    """
+    Save a label volume compactly as a compressed NumPy ``.npz`` file
+
+    Only the bounding box of the labels is stored, in the smallest integer
+    type which can hold them, and the file is compressed so runs of equal
+    labels take very little space.
+
+    :param fname: Output file name
+    :param cropped: Labels within the bounding box, 0 for background
+    :param offset: Position of the bounding box within the full grid
+    :param shape: Full grid shape
+    :param affine: Optional 4x4 grid to world transformation to store with the labels
+    """
+    cropped = np.asarray(cropped)
+    arrays = {
+        "labels" : cropped.astype(label_dtype(cropped.max() if cropped.size else 0)),
+        "offset" : np.array(offset, dtype=np.int64),
+        "shape" : np.array(shape, dtype=np.int64),
+    }
+    if affine is not None:
+        arrays["affine"] = np.asarray(affine, dtype=np.double)
+    np.savez_compressed(fname, **arrays)
+
+def load_labels(fname):
+    """
+    Load a label volume saved by ``save_labels`` back into a full-grid array
+
+    :return: Tuple of (full-grid labels, affine or None if none was saved)
+    """
+    with np.load(fname) as arrays:
+        cropped = arrays["labels"]
+        offset = arrays["offset"]
+        roi = np.zeros(tuple(arrays["shape"]), dtype=cropped.dtype)
+        roi[tuple(slice(start, start + size) for start, size in zip(offset, cropped.shape))] = cropped
+        affine = arrays["affine"] if "affine" in arrays.files else None
+    return roi, affine
+
+def load_roi(fname, name="supervoxels"):
+    """
+    Load a label volume saved by ``save_labels`` as a Quantiphyse ROI
+
+    :return: NumpyData ROI on the saved grid, or an identity grid if no affine was saved
+    """
+    roi, affine = load_labels(fname)
+    if affine is None:
+        affine = np.identity(4)
+    return NumpyData(roi, grid=DataGrid(roi.shape, affine), name=name, roi=True)
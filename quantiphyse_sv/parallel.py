@@ -0,0 +1,95 @@
+"""
+Quantiphyse - Helpers for running supervoxel jobs in a process pool
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import concurrent.futures
+
+import numpy as np
+
+import maskslic
+
+from .features import seeded
+
+def single_label(mask):
+    """
+    Labels for a mask too small to be divided, as maskslic fails with one seed
+    """
+    return np.where(mask > 0, 0, -1)
+
+def perfslic_job(img, mask, n_supervoxels, slic_kwargs):
+    """
+    Picklable wrapper around ``maskslic.perfslic`` for use with ``run_jobs``
+
+    ``slic_kwargs`` may include ``random_state`` to seed the run, see ``features.seeded``.
+    """
+    if n_supervoxels < 2:
+        return single_label(mask)
+    slic_kwargs = dict(slic_kwargs)
+    with seeded(slic_kwargs.pop("random_state", None)):
+        return maskslic.perfslic(img, mask, n_supervoxels=n_supervoxels, **slic_kwargs)
+
+def slic_features_job(features, mask, n_supervoxels, slic_kwargs):
+    """
+    Picklable job which clusters a precomputed multichannel feature volume
+
+    This is used when feature reduction has been done by the plugin rather
+    than inside perfslic. The features are clustered with the same ``slic``
+    settings perfslic uses, but PCA options are not passed on.
+    """
+    if n_supervoxels < 2:
+        return single_label(mask)
+    slic_kwargs = dict(slic_kwargs)
+    slic_kwargs.pop("n_pca_components", None)
+    slic_kwargs.pop("random_state", None)
+    return maskslic.slic(features, n_segments=n_supervoxels, mask=mask,
+                         multichannel=False, multifeat=True, **slic_kwargs)
+
+def run_jobs(fn, jobs, n_workers=1):
+    """
+    Run ``fn(*job)`` for each job, yielding ``(index, result)`` pairs
+
+    With a single worker the jobs are run one after another in this process.
+    Otherwise they are spread over a process pool, with no more than
+    ``n_workers`` jobs in flight at a time so that the arguments of queued
+    jobs are not all pickled up front. Results are yielded in completion
+    order.
+
+    :param fn: Picklable top-level function
+    :param jobs: Iterable of argument tuples
+    :param n_workers: Number of worker processes
+    """
+    if n_workers <= 1:
+        for idx, job in enumerate(jobs):
+            yield idx, fn(*job)
+        return
+
+    jobs = iter(enumerate(jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = {}
+        for idx, job in jobs:
+            pending[executor.submit(fn, *job)] = idx
+            if len(pending) >= n_workers:
+                break
+
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                idx = pending.pop(future)
+                yield idx, future.result()
+                for next_idx, job in jobs:
+                    pending[executor.submit(fn, *job)] = next_idx
+                    break
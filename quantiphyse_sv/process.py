@@ -16,44 +16,756 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import numpy as np
+import contextlib
+import multiprocessing
+import os
+import time
 
+import numpy as np
 import maskslic
 
 from quantiphyse.processes import Process
+from quantiphyse.data.extras import MatrixExtra
+from quantiphyse.utils import QpException
+
+from .engines import get_engine, DEFAULT_ENGINE
+from .tiling import tiled_slic
+from .regions import region_slic
+from .labels import assemble_labels, compact_labels, save_labels, label_dtype
+from .features import streaming_pca, extract_features, modality_features, smooth_features, SMOOTHING_METHODS
+from .source import crop_data, ModalityStack, MappedCrop
+from .cache import FEATURE_CACHE, ResultCache, content_hash
+from .sweep import sweep_combinations, run_sweep
+from .stats import quality_metrics, supervoxel_stats
+from .adjacency import adjacent_pairs, feature_distances, save_adjacency
+from .profiling import StageProfiler
+from .incremental import incremental_slic
+from .warmstart import warm_slic
+from .pyramid import pyramid_slic, coarse_slic, fit_factor
+from .cleanup import cleanup_labels
+
+#: Options which do not affect the supervoxel labels, so are left out of result cache keys.
+#: The data and ROIs are included by content rather than by name
+_UNCACHED_OPTIONS = ("data", "roi", "output-name", "n-workers", "profile", "profile-file", "stats",
+                     "adjacency", "adjacency-file", "compact-file", "feature-cache",
+                     "feature-cache-memory", "memory-map", "cache-dir", "cache-size",
+                     "threads")
+
+#: Values of the precision option and the type the cropped data is converted to
+_PRECISIONS = {None : None, "float32" : np.float32, "float64" : np.float64}
+
+#: Change this when a change to the clustering gives different results for the same options
+RESULT_CACHE_VERSION = 1
+
+def _hashable(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(np.asarray(value).tolist())
+    return value
+
+def _run_job(worker_id, queue, job, task, args):
+    """
+    Background worker which runs one task of a ``SupervoxelsJob``
+
+    :return: Tuple of worker ID, success and either (outputs, log, features
+             to cache) or the exception raised
+    """
+    # Pool workers are daemonic, which would stop tiled, per-region and
+    # sweep runs starting their own worker processes
+    multiprocessing.current_process().daemon = False
+    job.queue = queue
+    try:
+        outputs = getattr(job, task)(*args)
+        return worker_id, True, (outputs, job.get_log(), job.new_features)
+    except Exception as exc:
+        # Logged by the process when the run fails
+        exc.log = job.get_log()
+        return worker_id, False, exc
+
+class SupervoxelsJob(object):
+    """
+    The work of one run of the Supervoxels process
+
+    The job is set up by ``SupervoxelsProcess.run`` and passed to a
+    background worker, so it must be picklable. Steps and progress are
+    sent back through the worker queue as ``(kind, value)`` pairs, while log
+    messages are returned with the outputs.
+
+    ``grid`` is the grid of the data, ``multimodal`` is True for a list of
+    data sets and ``cached_features`` holds features from the feature cache,
+    if there were any. Features the job computes for the cache are kept in
+    ``new_features``. If ``cancel_event`` is set the job stops at the next
+    stage boundary.
+    """
+    def __init__(self, options, outdir=""):
+        """
+        :param options: Process options. Those used by the job are removed
+        :param outdir: Output folder for relative output file names
+        """
+        self.outdir = outdir
+        self.grid, self.multimodal = None, False
+        self.cached_features, self.new_features = None, None
+        self.queue, self.cancel_event = None, None
+        self._log = []
+        self._profile_file = options.pop('profile-file', None)
+        self._profile = options.pop('profile', False) or self._profile_file is not None
+        self._profiler = StageProfiler(trace_memory=self._profile)
+        self._stats = options.pop('stats', False)
+        self._adjacency_file = options.pop('adjacency-file', None)
+        self._adjacency = options.pop('adjacency', False) or self._adjacency_file is not None
+        self._compact_file = options.pop('compact-file', None)
+        self._cache, self._cache_key = None, None
+        self._cleanup = options.pop('cleanup', False)
+        self._min_size_factor = options.pop('min-size-factor', 0.5)
+        self._streaming_pca = options.pop('streaming-pca', False)
+
+        # Threads are used by the stages the plugin runs itself, e.g. smoothing,
+        # and for the SLIC iterations by engines which support it
+        threads = options.pop('threads', 1)
+        engine_name = options.pop('engine', DEFAULT_ENGINE)
+        self._image_job, self._features_job, threaded = get_engine(engine_name)
+        if threads > 1 and threaded:
+            options["threads"] = threads
+        elif threads > 1:
+            self.log("WARNING: the %s engine clusters on a single thread - threads are only used "
+                     "for smoothing done by the plugin\n" % engine_name)
+        self._threads = threads
+
+        self._precision = options.pop('precision', None)
+        if self._precision not in _PRECISIONS:
+            raise QpException("Unknown precision: %s (must be float32 or float64)" % self._precision)
+        self._smoothing = options.pop('smoothing', "gaussian")
+        if self._smoothing not in SMOOTHING_METHODS:
+            raise QpException("Unknown smoothing method: %s (must be %s)"
+                              % (self._smoothing, " or ".join(SMOOTHING_METHODS)))
+
+    def log(self, msg):
+        """
+        Add text to the job log
+        """
+        self._log.append(msg)
+
+    def get_log(self):
+        """
+        :return: Text logged by the job
+        """
+        return "".join(self._log)
+
+    @property
+    def dtype(self):
+        """
+        Type the cropped data is converted to, or None to leave it unchanged
+        """
+        return _PRECISIONS[self._precision]
+
+    def set_result_cache(self, cache, key):
+        """
+        Store the labels in a result cache when the job finishes
+
+        :param cache: ``ResultCache`` instance
+        :param key: Key for the result
+        """
+        self._cache, self._cache_key = cache, key
+
+    def feature_key(self, data, slices, ncomp, sigma, random_state=None):
+        """
+        Key for the features of the cropped data in ``FEATURE_CACHE``
+
+        Features depend only on the data, the bounding box and the preprocessing
+        options, so changes to other options (or to the ROI within the same
+        bounding box) can reuse them. The PCA options only matter for timeseries.
+
+        :return: Tuple of (key, source object or objects)
+        """
+        source, modalities = data, None
+        if isinstance(data, ModalityStack):
+            # The normalisation depends on the ROI, so the values it used are part of the key
+            source, modalities = tuple(data.datas), tuple(data.transforms)
+        source_id = tuple(id(obj) for obj in source) if modalities else id(data)
+        pca = (ncomp, self._streaming_pca, random_state) if data.nvols > 1 else None
+        key = (source_id, tuple((s.start, s.stop) for s in slices),
+               pca, _hashable(sigma), _hashable(data.grid.spacing),
+               self._precision, self._smoothing, modalities)
+        return key, source
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the run, reporting it as a process step and logging
+        the time and peak memory use if profiling is enabled
+
+        A cancelled run stops before the stage starts and as soon as it ends,
+        so the following stages are not run for results which will be dropped.
+        """
+        self._check_cancelled()
+        self._send("step", name)
+        with self._profiler.stage(name) as record:
+            yield
+        self._check_cancelled()
+        if self._profile:
+            if record["peak_memory"] is not None:
+                self.log("%s took %.2f s, peak memory %.1f Mb\n"
+                         % (name, record["time"], float(record["peak_memory"]) / (1024 * 1024)))
+            else:
+                self.log("%s took %.2f s\n" % (name, record["time"]))
+
+    def _send(self, kind, value):
+        if self.queue is not None:
+            self.queue.put((kind, value))
+
+    def _progress(self, complete):
+        """
+        Report progress from the computation, stopping it if the process has
+        been cancelled
+        """
+        self._check_cancelled()
+        self._send("progress", complete)
+
+    def _check_cancelled(self):
+        """
+        Stop the computation if the process has been cancelled
+        """
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise QpException("Process was cancelled")
+
+    def output_path(self, fname):
+        """
+        :return: Path of an output file, relative to the output folder if not
+                 absolute, creating its directory if required
+        """
+        if not os.path.isabs(fname):
+            fname = os.path.join(self.outdir, fname)
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        return fname
+
+    def _profile_outputs(self, output_name):
+        """
+        Stage timings as a table extra named ``<output-name>_profile``, also saved
+        as JSON if a profile file was given
+
+        :return: Sequence of outputs in the form used by ``SupervoxelsProcess._add_outputs``
+        """
+        if not self._profile:
+            return []
+        self.log("Total time %.2f s\n" % self._profiler.total_time())
+        if self._profile_file:
+            self._profiler.save(self.output_path(self._profile_file), process=SupervoxelsProcess.PROCESS_NAME,
+                                output_name=output_name)
+        extra = MatrixExtra(output_name + "_profile", self._profiler.rows(),
+                            col_headers=["Stage", "Time (s)", "Peak memory (Mb)"])
+        return [(extra.name, extra, False)]
+
+    def _label_outputs(self, labels, img, slices, output_name):
+        """
+        Optional per-supervoxel statistics and adjacency graph of the cropped labels,
+        and the compact label file and result cache entry if required
+
+        Statistics are table extras named ``<output-name>_stats`` and, for 4D
+        data, ``<output-name>_timecourses``. The adjacency graph is a table of
+        neighbouring supervoxels named ``<output-name>_adjacency``, also saved
+        as a sparse matrix file if an adjacency file was given.
+
+        :return: Sequence of outputs in the form used by ``SupervoxelsProcess._add_outputs``
+        """
+        if self._compact_file:
+            offset, cropped = compact_labels(np.asarray(labels) + 1)
+            offset = [start + s.start for start, s in zip(offset, slices)]
+            save_labels(self.output_path(self._compact_file), cropped, offset, self.grid.shape,
+                        self.grid.affine)
+
+        if self._cache_key is not None:
+            values = np.asarray(labels) + 1
+            self._cache.put(self._cache_key, values.astype(label_dtype(values.max())))
+
+        if not (self._stats or self._adjacency) or not np.any(labels >= 0):
+            return []
+        with self.stage("Statistics"):
+            stats = supervoxel_stats(labels, img, [s.start for s in slices])
+
+        outputs = []
+        if self._stats:
+            voxel_volume = float(np.prod(self.grid.spacing))
+            rows = []
+            for idx, label in enumerate(stats["label"]):
+                voxels = int(stats["voxels"][idx])
+                rows.append([int(label), voxels, round(voxels * voxel_volume, 4)]
+                            + [round(float(c), 2) for c in stats["centroid"][idx]]
+                            + [float(stats["mean"][idx]), float(stats["std"][idx])])
+            extra = MatrixExtra(output_name + "_stats", rows,
+                                col_headers=["Supervoxel", "Voxels", "Volume", "Centroid x", "Centroid y",
+                                             "Centroid z", "Mean", "Std"])
+            outputs.append((extra.name, extra, False))
+            if stats["timecourse"] is not None:
+                extra = MatrixExtra(output_name + "_timecourses", stats["timecourse"].tolist(),
+                                    row_headers=[str(label) for label in stats["label"]],
+                                    col_headers=["Volume %i" % (vol + 1)
+                                                 for vol in range(stats["timecourse"].shape[1])])
+                outputs.append((extra.name, extra, False))
+
+        if self._adjacency:
+            with self.stage("Adjacency"):
+                outputs += self._adjacency_outputs(labels, stats, output_name)
+        return outputs
+
+    def _adjacency_outputs(self, labels, stats, output_name):
+        """
+        Adjacency graph of the supervoxels, with the distance between the mean
+        signal (or timecourse) of each pair of neighbours
+        """
+        n_labels = int(stats["label"].max())
+        means = stats["timecourse"] if stats["timecourse"] is not None else stats["mean"][:, np.newaxis]
+        label_means = np.zeros((n_labels, means.shape[1]))
+        label_means[stats["label"] - 1] = means
+        pairs, boundary = adjacent_pairs(labels)
+        distance = feature_distances(pairs, label_means)
+        self.log("Found %i pairs of adjacent supervoxels\n" % len(pairs))
+
+        if self._adjacency_file:
+            save_adjacency(self.output_path(self._adjacency_file), pairs, boundary, distance, n_labels)
+
+        if not len(pairs):
+            return []
+        rows = [[int(first) + 1, int(second) + 1, int(count), float(dist)]
+                for (first, second), count, dist in zip(pairs, boundary, distance)]
+        extra = MatrixExtra(output_name + "_adjacency", rows,
+                            col_headers=["Supervoxel 1", "Supervoxel 2", "Boundary", "Distance"])
+        return [(extra.name, extra, False)]
+
+    def _clean(self, labels, n_supervoxels):
+        """
+        Enforce connectivity, merge small supervoxels and relabel, if requested
+
+        This is not used for warm-started or incremental runs, which keep the
+        label values of the supervoxels they start from.
+        """
+        if not self._cleanup:
+            return labels
+        with self.stage("Cleanup"):
+            min_size = int(self._min_size_factor * np.count_nonzero(labels >= 0) / max(1, n_supervoxels))
+            labels, n_merged = cleanup_labels(labels, min_size)
+        self.log("Merged %i small or disconnected fragments, leaving %i supervoxels\n"
+                 % (n_merged, labels.max() + 1))
+        return labels
+
+    def generate(self, img, mask, slices, n_supervoxels, slic_kwargs, feature_cache,
+                 pca_batch, per_region, tile_options, n_workers, output_name):
+        """
+        Generate a single supervoxel ROI
+        """
+        slic_fn = self._image_job
+        ncomp = slic_kwargs["n_pca_components"]
+        data_img = img
+        if feature_cache or self.own_features(slic_kwargs["sigma"]):
+            # Smoothing is included in the features
+            img = self._features(img, slic_kwargs, pca_batch, feature_cache)
+            slic_fn, slic_kwargs = self._features_job, dict(slic_kwargs, sigma=0)
+            self._progress(0.5)
+        elif self._streaming_pca and img.ndim == 4:
+            with self.stage("PCA"):
+                img = streaming_pca(img, ncomp, batch=pca_batch)
+            slic_fn = self._features_job
+            self._progress(0.5)
+
+        # Without precomputed features this includes perfslic's own preprocessing
+        with self.stage("Clustering"):
+            if per_region:
+                labels = region_slic(img, mask, n_supervoxels, slic_kwargs,
+                                     n_workers=n_workers, tile_options=tile_options,
+                                     slic_fn=slic_fn, progress=self._progress)
+            elif tile_options is not None:
+                labels = tiled_slic(img, mask, n_supervoxels, slic_kwargs,
+                                    n_workers=n_workers, slic_fn=slic_fn, progress=self._progress,
+                                    **tile_options)
+            else:
+                labels = slic_fn(np.asarray(img), mask, n_supervoxels, slic_kwargs)
+        labels = self._clean(labels, n_supervoxels)
+        with self.stage("Assemble output"):
+            newroi, saved = assemble_labels(labels, slices, self.grid.shape)
+        self.log("Output stored as %s, saving %.1f Mb\n" % (newroi.dtype, float(saved) / (1024 * 1024)))
+        stats = self._label_outputs(labels, data_img, slices, output_name)
+        return [(output_name, newroi, True)] + stats + self._profile_outputs(output_name)
+
+    def warm_start(self, img, mask, slices, initial, slic_kwargs, use_cache, pca_batch,
+                   tol, output_name):
+        """
+        Generate supervoxels starting from the centres of an existing supervoxel ROI
+        """
+        features = self._features(img, slic_kwargs, pca_batch, use_cache)
+        with self.stage("Clustering"):
+            labels, n_iter = warm_slic(features, mask, initial, slic_kwargs["compactness"],
+                                       self.grid.spacing, slic_kwargs["max_iter"], tol)
+
+        # Standard runs always do max_iter iterations, and the same again to
+        # refine the seed positions if recompute-seeds is set
+        cold_iter = slic_kwargs["max_iter"] * (2 if slic_kwargs["recompute_seeds"] else 1)
+        self.log("Warm start took %i iterations, saving %i iterations\n" % (n_iter, cold_iter - n_iter))
+        with self.stage("Assemble output"):
+            newroi, _ = assemble_labels(labels, slices, self.grid.shape)
+        stats = self._label_outputs(labels, img, slices, output_name)
+        return [(output_name, newroi, True)] + stats + self._profile_outputs(output_name)
+
+    def pyramid(self, img, mask, slices, n_supervoxels, slic_kwargs, use_cache, pca_batch,
+                factor, iterations, tol, output_name):
+        """
+        Generate supervoxels on downsampled data and refine them at full resolution
+        """
+        features = self._features(img, slic_kwargs, pca_batch, use_cache)
+        with self.stage("Clustering"):
+            labels = pyramid_slic(features, mask, n_supervoxels, slic_kwargs, factor, iterations, tol,
+                                  self._features_job)
+        labels = self._clean(labels, n_supervoxels)
+        with self.stage("Assemble output"):
+            newroi, _ = assemble_labels(labels, slices, self.grid.shape)
+        stats = self._label_outputs(labels, img, slices, output_name)
+        return [(output_name, newroi, True)] + stats + self._profile_outputs(output_name)
+
+    def cached(self, img, slices, labels, output_name):
+        """
+        Build the outputs from a cached result
+        """
+        with self.stage("Assemble output"):
+            newroi, _ = assemble_labels(labels, slices, self.grid.shape)
+        stats = self._label_outputs(labels, img, slices, output_name)
+        return [(output_name, newroi, True)] + stats + self._profile_outputs(output_name)
+
+    def preview(self, img, mask, slices, n_supervoxels, slic_kwargs, use_cache, pca_batch,
+                max_voxels, output_name):
+        """
+        Quick preview of the supervoxels, clustered on a copy of the data
+        downsampled to no more than ``max_voxels`` voxels
+        """
+        features = self._features(img, slic_kwargs, pca_batch, use_cache)
+        factor = fit_factor(mask.shape, self.grid.spacing, max_voxels)
+        with self.stage("Clustering"):
+            labels = coarse_slic(features, mask, n_supervoxels, slic_kwargs, factor, self._features_job)
+        with self.stage("Assemble output"):
+            newroi, _ = assemble_labels(labels, slices, self.grid.shape)
+        # The preview is only an overlay, it should not replace the current ROI
+        return [(output_name, newroi, False)]
+
+    def update(self, img, mask, slices, previous, slic_kwargs, feature_cache, pca_batch,
+               margin, output_name):
+        """
+        Update a previous supervoxel ROI after the ROI has been edited, reclustering
+        only the supervoxels near the edit
+        """
+        slic_fn, features = self._image_job, img
+        if feature_cache or self.own_features(slic_kwargs["sigma"]):
+            features = self._features(img, slic_kwargs, pca_batch, feature_cache)
+            slic_fn, slic_kwargs = self._features_job, dict(slic_kwargs, sigma=0)
+
+        with self.stage("Clustering"):
+            labels, n_new = incremental_slic(features, mask, previous, slic_kwargs, margin, slic_fn)
+        self.log("Reclustered %i supervoxels\n" % n_new)
+        with self.stage("Assemble output"):
+            newroi, _ = assemble_labels(labels, slices, self.grid.shape)
+        stats = self._label_outputs(labels, img, slices, output_name)
+        return [(output_name, newroi, True)] + stats + self._profile_outputs(output_name)
+
+    def own_features(self, sigma):
+        """
+        :return: True if the features must be computed by the plugin rather than by perfslic,
+                 i.e. for multi-modal data (which is not a timeseries) or when the plugin
+                 does the smoothing
+        """
+        if self.multimodal:
+            return True
+        return self._smoothing != "gaussian" and bool(np.any(np.asarray(sigma) > 0))
+
+    def _features(self, img, slic_kwargs, pca_batch, use_cache=True, sigma=None):
+        """
+        Get the smoothed feature volume for the cropped data, using the cached
+        copy if there is one
+
+        Unless streaming PCA was requested these are the same features perfslic
+        computes, so cached and uncached runs give the same labels.
+
+        :param sigma: Smoothing to apply, if not the one in ``slic_kwargs``
+        """
+        ncomp = slic_kwargs.get("n_pca_components", 3)
+        if sigma is None:
+            sigma = slic_kwargs["sigma"]
+        features = self.cached_features
+        if features is None:
+            self.log("Computing features\n")
+            with self.stage("Feature extraction"):
+                if self.multimodal:
+                    features = modality_features(img, ncomp, pca_batch)
+                else:
+                    features = extract_features(img, ncomp, pca_batch, self._streaming_pca,
+                                                slic_kwargs.get("random_state"))
+            with self.stage("Smoothing"):
+                features = smooth_features(features, sigma, self.grid.spacing, self._smoothing, self._threads)
+            if use_cache:
+                self.new_features = features
+        else:
+            self.log("Using cached features\n")
+        return features
+
+    def sweep(self, img, mask, slices, combos, ncomp, pca_batch, use_cache,
+              slic_kwargs, n_workers, output_name):
+        """
+        Generate one output ROI for each combination of swept options
+
+        The unsmoothed features are computed once and shared by all combinations.
+        A summary table of clustering times and quality metrics is added as an
+        extra named ``<output-name>_sweep``
+        """
+        start = time.time()
+        features = self._features(img, dict(slic_kwargs, n_pca_components=ncomp), pca_batch, use_cache, 0)
+        self.log("Preprocessing took %.2f s\n" % (time.time() - start))
+
+        outputs, rows = [], [None] * len(combos)
+        with self.stage("Clustering"):
+            for idx, labels, elapsed in run_sweep(features, mask, combos, self.grid.spacing,
+                                                  slic_kwargs, n_workers, self._features_job,
+                                                  self._smoothing, self._threads):
+                combo = combos[idx]
+                name = "%s_%i" % (output_name, idx + 1)
+                newroi, _ = assemble_labels(labels, slices, self.grid.shape)
+                outputs.append((name, newroi, False))
+                metrics = quality_metrics(labels, features)
+                rows[idx] = [name, combo["n-supervoxels"], combo["compactness"], combo["sigma"],
+                             metrics["n_supervoxels"], round(elapsed, 3),
+                             round(metrics["size_cv"], 4), round(metrics["unexplained_variance"], 4)]
+                self.log("%s: n-supervoxels=%s compactness=%s sigma=%s took %.2f s\n"
+                         % (name, combo["n-supervoxels"], combo["compactness"], combo["sigma"], elapsed))
+                self._progress(float(len(outputs)) / len(rows))
+
+        extra = MatrixExtra(output_name + "_sweep", rows,
+                            col_headers=["Output", "n-supervoxels", "compactness", "sigma",
+                                         "Supervoxels", "Time (s)", "Size CV", "Unexplained variance"])
+        outputs.append((extra.name, extra, False))
+        return outputs + self._profile_outputs(output_name)
 
 class SupervoxelsProcess(Process):
     """
     Process to run 3d supervoxel generation
+
+    The data is loaded and cropped in ``run``, and the clustering is done by
+    a ``SupervoxelsJob`` in a background worker started with ``start_bg``.
+    Outputs are only added to the IVM by ``finished``, so a cancelled run
+    leaves the IVM unchanged.
     """
     PROCESS_NAME = "Supervoxels"
 
     def __init__(self, ivm, **kwargs):
-        Process.__init__(self, ivm, **kwargs)
+        Process.__init__(self, ivm, worker_fn=_run_job, **kwargs)
+        self._grid = None
+        self._job, self._cancel_event = None, None
+        self._feature_key, self._feature_source = None, None
 
     def run(self, options):
-        data = self.get_data(options)
-        roi = self.get_roi(options, data.grid)
-        n_supervoxels = options.pop('n-supervoxels')
+        cache_options = dict((key, value) for key, value in options.items() if key not in _UNCACHED_OPTIONS)
+        self._job = job = SupervoxelsJob(options, self.outdir)
+        # Cancelling asks the worker to stop at the next stage, rather than just ignoring its result
+        self._cancel_event = None
+        if self._multiproc and not self._sync:
+            self._cancel_event = multiprocessing.Manager().Event()
+        job.cancel_event = self._cancel_event
+
+        with self._stage("Load data"):
+            data = self._get_data(options)
+            roi = self.get_roi(options, data.grid)
+        n_supervoxels = options.pop('n-supervoxels', None)
         recompute_seeds = options.pop('recompute-seeds', True)
-        seed_type = options.get('seed-type', 'nplace')
+        seed_type = options.pop('seed-type', 'nplace')
         output_name = options.pop('output-name', "supervoxels")
         ncomp = options.pop('n-components', 3)
         compactness = options.pop('compactness', 0.1)
+        tiled = options.pop('tiled', False)
+        tile_memory = options.pop('tile-memory', 512)
+        tile_overlap = options.pop('tile-overlap', 4)
+        n_workers = options.pop('n-workers', 1)
+        per_region = options.pop('per-region', False)
+        pca_batch = options.pop('pca-batch', 8)
+        memory_map = options.pop('memory-map', False)
+        sigma = options.pop('sigma', 0)
+        feature_cache = options.pop('feature-cache', False)
+        FEATURE_CACHE.set_budget(options.pop('feature-cache-memory', 1024) * 1024 * 1024)
+        sweep = options.pop('sweep', None)
+        previous = options.pop('previous', None)
+        margin = options.pop('incremental-margin', 2)
+        initial = options.pop('initial-labels', None)
+        max_iter = options.pop('max-iter', 10)
+        tol = options.pop('convergence-tol', 0.01)
+        pyramid = options.pop('pyramid', False)
+        pyramid_factor = options.pop('pyramid-factor', 2)
+        pyramid_iter = options.pop('pyramid-iterations', 3)
+        preview = options.pop('preview', False)
+        preview_voxels = options.pop('preview-voxels', 16384)
+        cache_dir = options.pop('cache-dir', None)
+        cache_size = options.pop('cache-size', 1024)
+        random_seed = options.pop('random-seed', None)
+
+        with self._stage("Crop"):
+            slices = roi.get_bounding_box()
+            mask = roi.raw()[slices]
+            if isinstance(data, ModalityStack):
+                img = data.crop(slices, mask, memory_map)
+            else:
+                img = crop_data(data, slices, memory_map, job.dtype)
+        self._grid = job.grid = data.grid
+        job.multimodal = isinstance(data, ModalityStack)
+        if tiled and not isinstance(img, MappedCrop):
+            job.log("WARNING: the cropped data is held in memory - tile-memory only bounds memory "
+                    "use when memory-map can read the data from its file\n")
 
-        img = data.raw()
-        slices = roi.get_bounding_box()
-        img = img[slices]
-        mask = roi.raw()[slices]
-
-        labels = maskslic.perfslic(img, mask,
-                                   n_supervoxels=n_supervoxels,
-                                   spacing=data.grid.spacing,
-                                   seed_type=seed_type,
-                                   recompute_seeds=recompute_seeds,
-                                   n_pca_components=ncomp,
-                                   compactness=compactness,
-                                   **options)
-        newroi = np.zeros(data.grid.shape)
-        newroi[slices] = np.array(labels, dtype=np.int32) + 1
-        self.ivm.add(newroi, grid=data.grid, name=output_name, roi=True, make_current=True)
+        initial_labels, previous_labels = None, None
+        if initial is not None:
+            initial_labels = np.array(self.get_roi({"roi" : initial}, data.grid).raw()[slices])
+        if previous is not None:
+            previous_labels = np.array(self.get_roi({"roi" : previous}, data.grid).raw()[slices])
+
+        if cache_dir and not sweep and not preview:
+            with self._stage("Cache lookup"):
+                cache = ResultCache(job.output_path(cache_dir), cache_size * 1024 * 1024)
+                arrays = [arr for arr in (img, mask, initial_labels, previous_labels) if arr is not None]
+                cache_options.update(spacing=list(data.grid.spacing), maskslic=maskslic.__version__,
+                                     version=RESULT_CACHE_VERSION)
+                key = content_hash(arrays, cache_options)
+                labels = cache.get(key)
+            if labels is not None:
+                job.log("Using cached result %s\n" % key)
+                self._start("cached", img, slices, labels.astype(np.int64) - 1, output_name)
+                return
+            job.set_result_cache(cache, key)
+
+        # Features from an earlier run are looked up here, as the cache belongs to this process
+        self._feature_key, self._feature_source = job.feature_key(data, slices, ncomp, 0 if sweep else sigma,
+                                                                  random_seed)
+        if feature_cache:
+            job.cached_features = FEATURE_CACHE.get(self._feature_key, self._feature_source)
+
+        if sweep:
+            slic_kwargs = dict(spacing=data.grid.spacing,
+                               seed_type=seed_type,
+                               recompute_seeds=recompute_seeds,
+                               max_iter=max_iter,
+                               random_state=random_seed,
+                               **options)
+            defaults = {"n-supervoxels" : n_supervoxels, "compactness" : compactness, "sigma" : sigma}
+            combos = sweep_combinations(sweep, defaults)
+            self._start("sweep", img, mask, slices, combos, ncomp, pca_batch,
+                        feature_cache, slic_kwargs, n_workers, output_name)
+            return
+
+        if n_supervoxels is None and previous is None and initial is None:
+            raise QpException("Number of supervoxels must be given")
+
+        slic_kwargs = dict(spacing=data.grid.spacing,
+                           seed_type=seed_type,
+                           recompute_seeds=recompute_seeds,
+                           n_pca_components=ncomp,
+                           compactness=compactness,
+                           sigma=sigma,
+                           max_iter=max_iter,
+                           random_state=random_seed,
+                           **options)
+        if initial is not None:
+            self._start("warm_start", img, mask, slices, initial_labels, slic_kwargs,
+                        feature_cache, pca_batch, tol, output_name)
+            return
+
+        if previous is not None:
+            self._start("update", img, mask, slices, previous_labels, slic_kwargs,
+                        feature_cache, pca_batch, margin, output_name)
+            return
+
+        if preview:
+            self._start("preview", img, mask, slices, n_supervoxels, slic_kwargs,
+                        feature_cache, pca_batch, preview_voxels, output_name)
+            return
+
+        if pyramid:
+            self._start("pyramid", img, mask, slices, n_supervoxels, slic_kwargs,
+                        feature_cache, pca_batch, pyramid_factor, pyramid_iter, tol, output_name)
+            return
+
+        tile_options = dict(tile_memory=tile_memory, overlap=tile_overlap)
+        if not tiled:
+            tile_options = None
+        self._start("generate", img, mask, slices, n_supervoxels, slic_kwargs,
+                    feature_cache, pca_batch, per_region, tile_options,
+                    n_workers, output_name)
+
+    def _start(self, task, *args):
+        """
+        Run a task of the job in the background worker
+        """
+        self.start_bg([self._job, task, args])
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        """
+        Stage of the run done in this process, before the worker starts
+        """
+        self.sig_step.emit(name)
+        with self._job.stage(name):
+            yield
+
+    def timeout(self, queue):
+        """
+        Report the steps and progress sent by the worker
+        """
+        while queue is not None and not queue.empty():
+            kind, value = queue.get()
+            if kind == "step":
+                self.sig_step.emit(value)
+            else:
+                self.sig_progress.emit(value)
+
+    def cancel(self):
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+        Process.cancel(self)
+
+    def finished(self, worker_output):
+        outputs, log, features = worker_output[0]
+        self.log(log)
+        if features is not None:
+            FEATURE_CACHE.put(self._feature_key, self._feature_source, features)
+        self._add_outputs(outputs)
+
+    def _add_outputs(self, outputs):
+        """
+        Add output ROIs and extras to the IVM
+
+        :param outputs: Sequence of (name, label volume or Extra, make current) tuples
+        """
+        for name, output, make_current in outputs:
+            if isinstance(output, np.ndarray):
+                self.ivm.add(output, grid=self._grid, name=name, roi=True, make_current=make_current)
+            else:
+                self.ivm.add_extra(name, output)
+
+    def _get_data(self, options):
+        """
+        Get the data to cluster, which may be a list of co-registered data sets
+
+        :return: QpData instance, or ``ModalityStack`` if a list of data was given
+        """
+        normalisation = options.pop('normalisation', "range")
+        weights = options.pop('weights', None)
+        names = options.get('data', None)
+        if not isinstance(names, list):
+            if weights is not None:
+                raise QpException("Weights can only be given with a list of data")
+            return self.get_data(options)
+        options.pop('data')
+        return ModalityStack([self.get_data({"data" : name}) for name in names], normalisation, weights)
+
+def run_supervoxels(ivm, options):
+    """
+    Run the Supervoxels process and wait for it to finish, e.g. from a script
+
+    :param ivm: ImageVolumeManagement containing the data and ROI
+    :param options: Process options
+    :return: The finished process
+    """
+    process = SupervoxelsProcess(ivm, sync=True)
+    process.execute(options)
+    if process.status != Process.SUCCEEDED:
+        raise process.exception
+    return process
@@ -0,0 +1,89 @@
+"""
+Quantiphyse - Timing and memory profiling of supervoxel generation
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import contextlib
+import json
+import time
+import tracemalloc
+
+class StageProfiler(object):
+    """
+    Records the wall time and peak memory use of each stage of a run
+
+    Peak memory is measured with ``tracemalloc``, which includes Numpy
+    arrays, and is the largest amount of memory allocated during the stage
+    over and above what was already allocated when it started. Memory used
+    by worker processes is not included. Tracing slows allocation down, so
+    it is only enabled when ``trace_memory`` is True. Stages should not be
+    nested when tracing memory.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager which times the code it contains
+
+        :param name: Stage name
+        :return: Dictionary describing the stage, which is filled in on exit
+        """
+        record = {"stage" : name, "time" : None, "peak_memory" : None}
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record["time"] = time.time() - start
+            if tracing:
+                record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.stages.append(record)
+
+    def total_time(self):
+        """
+        :return: Total time of all recorded stages in seconds
+        """
+        return sum(record["time"] for record in self.stages)
+
+    def rows(self):
+        """
+        :return: List of [stage, time (s), peak memory (Mb)] rows for a table
+        """
+        rows = []
+        for record in self.stages:
+            peak = record["peak_memory"]
+            rows.append([record["stage"], round(record["time"], 3),
+                         round(float(peak) / (1024 * 1024), 1) if peak is not None else ""])
+        return rows
+
+    def save(self, fname, **metadata):
+        """
+        Write the stage records to a JSON file
+
+        :param fname: Output file name
+        :param metadata: Additional values to store alongside the stages
+        """
+        report = dict(metadata)
+        report["stages"] = self.stages
+        report["total_time"] = self.total_time()
+        with open(fname, "w") as json_file:
+            json.dump(report, json_file, indent=2)
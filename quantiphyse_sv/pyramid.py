@@ -0,0 +1,146 @@
+"""
+Quantiphyse - Coarse-to-fine supervoxel generation
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+from .parallel import slic_features_job
+from .warmstart import warm_slic, fill_unassigned
+
+def pyramid_factors(spacing, factor):
+    """
+    Downsampling factor along each axis
+
+    The finest axis is downsampled by ``factor`` and coarser axes by less,
+    so anisotropic voxels become closer to isotropic at the coarse level.
+
+    :param spacing: Voxel spacing
+    :param factor: Downsampling factor along the finest axis
+    :return: Tuple of integer factors
+    """
+    spacing = np.asarray(spacing, dtype=np.double)
+    target = np.min(spacing) * factor
+    return tuple(max(1, int(round(target / size))) for size in spacing)
+
+def downsample(arr, factors):
+    """
+    Block average the first three axes of an array
+
+    Edges are padded by repeating the last voxel so every block is complete.
+
+    :param arr: 3D array, or 4D array with channels along the last axis
+    :param factors: Integer factor along each spatial axis
+    :return: Downsampled float32 array
+    """
+    shape = arr.shape[:3]
+    pad = [(0, (-size) % f) for size, f in zip(shape, factors)] + [(0, 0)] * (arr.ndim - 3)
+    arr = np.pad(np.asarray(arr, dtype=np.float32), pad, mode="edge")
+    blocks = []
+    for size, f in zip(arr.shape[:3], factors):
+        blocks += [size // f, f]
+    arr = arr.reshape(tuple(blocks) + arr.shape[3:])
+    return arr.mean(axis=(1, 3, 5))
+
+def upsample_labels(labels, factors, shape):
+    """
+    Nearest neighbour upsampling of a coarse label volume
+
+    :param labels: Coarse labels
+    :param factors: Integer factor along each spatial axis
+    :param shape: Full resolution shape
+    :return: Labels at full resolution
+    """
+    for axis, f in enumerate(factors):
+        labels = np.repeat(labels, f, axis=axis)
+    return labels[:shape[0], :shape[1], :shape[2]]
+
+def fit_factor(shape, spacing, max_voxels):
+    """
+    Smallest downsampling factor which brings a volume within a number of voxels
+
+    :param shape: Shape of the volume
+    :param spacing: Voxel spacing
+    :param max_voxels: Maximum number of voxels in the downsampled volume
+    :return: Factor along the finest axis, for ``pyramid_factors``
+    """
+    factor = 1
+    while True:
+        factors = pyramid_factors(spacing, factor)
+        coarse = [-(-size // f) for size, f in zip(shape[:3], factors)]
+        if np.prod(coarse) <= max_voxels or all(f >= size for f, size in zip(factors, shape[:3])):
+            return factor
+        factor += 1
+
+def coarse_slic(features, mask, n_supervoxels, slic_kwargs, factor=2, slic_fn=slic_features_job):
+    """
+    Generate supervoxels on a downsampled copy of the data and upsample them
+
+    :param features: Smoothed full resolution feature volume, from ``features.preprocess``
+    :param mask: Cropped mask
+    :param n_supervoxels: Number of supervoxels to aim for
+    :param slic_kwargs: Keyword arguments for ``slic_features_job``, including ``spacing``
+    :param factor: Downsampling factor along the finest axis
+    :param slic_fn: Job function used to cluster the coarse features
+    :return: Labels at full resolution, -1 outside the mask. Voxels in the mask
+             which were not covered at the coarse level take the label of the
+             nearest labelled block
+    """
+    mask = np.asarray(mask) > 0
+    spacing = np.asarray(slic_kwargs.get("spacing", [1, 1, 1]), dtype=np.double)
+    factors = pyramid_factors(spacing, factor)
+
+    coarse_features = downsample(features, factors)
+    coarse_fill = downsample(mask, factors)
+    coarse_mask = coarse_fill >= 0.5
+    if not np.any(coarse_mask):
+        coarse_mask = coarse_fill > 0
+
+    # maskslic measures its seed step in voxels, so the coarse spacing is
+    # scaled down by the factor to keep the same balance between spatial and
+    # feature distances as at full resolution
+    coarse_kwargs = dict(slic_kwargs, spacing=spacing * factors / float(factor), sigma=0)
+    coarse = slic_fn(coarse_features, coarse_mask, n_supervoxels, coarse_kwargs)
+    # Filling at the coarse level is much cheaper and covers every block
+    # which contains part of the mask
+    coarse = fill_unassigned(np.asarray(coarse), coarse_fill > 0)
+    return np.where(mask, upsample_labels(coarse, factors, mask.shape), -1)
+
+def pyramid_slic(features, mask, n_supervoxels, slic_kwargs, factor=2, iterations=3, tol=0.01,
+                 slic_fn=slic_features_job):
+    """
+    Generate supervoxels on a downsampled copy of the data and refine them at full resolution
+
+    The seed placement and most of the SLIC iterations run on the coarse
+    volume, which has ``factor**3`` fewer voxels for isotropic data. The
+    upsampled result is then used to warm-start a few full resolution
+    iterations.
+
+    :param features: Smoothed full resolution feature volume, from ``features.preprocess``
+    :param mask: Cropped mask
+    :param n_supervoxels: Number of supervoxels to aim for
+    :param slic_kwargs: Keyword arguments for ``slic_features_job``, including ``spacing``
+    :param factor: Downsampling factor along the finest axis
+    :param iterations: Maximum number of full resolution iterations
+    :param tol: Convergence tolerance for the full resolution iterations
+    :param slic_fn: Job function used to cluster the coarse features
+    :return: Labels in the same convention as perfslic, i.e. -1 outside the mask
+    """
+    initial = coarse_slic(features, mask, n_supervoxels, slic_kwargs, factor, slic_fn) + 1
+    spacing = np.asarray(slic_kwargs.get("spacing", [1, 1, 1]), dtype=np.double)
+    labels, _ = warm_slic(features, mask, initial, slic_kwargs.get("compactness", 0.1),
+                          spacing, max_iter=iterations, tol=tol)
+    return labels
@@ -0,0 +1,81 @@
+"""
+Quantiphyse - Per-region supervoxel generation
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+from .parallel import run_jobs, perfslic_job
+from .tiling import tiled_slic
+
+def region_bounding_box(mask):
+    """
+    :return: Tuple of slices covering the non-zero voxels of a boolean mask
+    """
+    slices = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other_axes))
+        slices.append(slice(nonzero[0], nonzero[-1] + 1))
+    return tuple(slices)
+
+def _region_job(img, mask, n_supervoxels, slic_kwargs, tile_options, slic_fn):
+    if tile_options is not None:
+        return tiled_slic(img, mask, n_supervoxels, slic_kwargs, slic_fn=slic_fn, **tile_options)
+    return slic_fn(img, mask, n_supervoxels, slic_kwargs)
+
+def region_slic(img, mask, n_supervoxels, slic_kwargs, n_workers=1, tile_options=None,
+                slic_fn=perfslic_job, progress=None):
+    """
+    Generate supervoxels independently within each region of a multi-region ROI
+
+    Each region is cropped to its own bounding box and given a share of
+    ``n_supervoxels`` proportional to its size. Regions are run in a process
+    pool and the labels are offset so they are unique across regions.
+
+    :param img: Cropped 3D or 4D image data
+    :param mask: Cropped 3D ROI with integer region labels
+    :param n_supervoxels: Total number of supervoxels to aim for
+    :param slic_kwargs: Other keyword arguments passed to ``maskslic.perfslic``
+    :param n_workers: Number of regions to process in parallel
+    :param tile_options: If given, keyword arguments for ``tiled_slic`` used to
+                         tile each region
+    :param slic_fn: Picklable job function used to cluster each region
+    :param progress: Optional callable taking the fraction of regions completed
+    :return: Labels in the same convention as perfslic, i.e. -1 outside the mask
+    """
+    region_ids, counts = np.unique(mask[mask > 0], return_counts=True)
+    total = np.sum(counts)
+    regions = []
+    for region_id, count in zip(region_ids, counts):
+        n_region = int(min(count, max(1, round(float(n_supervoxels) * count / total))))
+        regions.append((region_id, region_bounding_box(mask == region_id), n_region))
+
+    jobs = ((img[bbox], mask[bbox] == region_id, n_region, slic_kwargs, tile_options, slic_fn)
+            for region_id, bbox, n_region in regions)
+    out = -np.ones(mask.shape, dtype=np.int32)
+    n_labels = 0
+    for done, (idx, labels) in enumerate(run_jobs(_region_job, jobs, n_workers), 1):
+        if progress is not None:
+            progress(float(done) / len(regions))
+        region_id, bbox, _ = regions[idx]
+        labels = np.asarray(labels)
+        inside = (labels >= 0) & (mask[bbox] == region_id)
+        if not np.any(inside):
+            continue
+        out[bbox][inside] = labels[inside] + n_labels
+        n_labels += labels[inside].max() + 1
+    return out
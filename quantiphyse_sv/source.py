@@ -0,0 +1,170 @@
+"""
+Quantiphyse - Reading cropped input data for supervoxel clustering
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+from quantiphyse.utils import QpException
+
+#: Per-modality normalisations for ``ModalityStack``
+NORMALISATIONS = ("none", "range", "zscore")
+
+class MappedCrop(object):
+    """
+    Lazy view of a cropped box within a NIfTI file
+
+    Indexing with up to three slices (relative to the box) reads just that
+    part of the file through a memory map, so only the voxels which are
+    actually used become resident. Compressed files cannot be mapped, but
+    are still read incrementally rather than loaded in full. If ``dtype``
+    is given each part is converted to it as it is read.
+    """
+    def __init__(self, fname, slices, dtype=None):
+        self._proxy = nib.load(fname, mmap=True).dataobj
+        self._slices = tuple(slices)
+        self._dtype = dtype
+        self.shape = tuple(s.stop - s.start for s in self._slices) + tuple(self._proxy.shape[3:])
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        file_slices = []
+        for crop_slice, box_slice in zip(key[:3], self._slices):
+            start, stop, step = crop_slice.indices(box_slice.stop - box_slice.start)
+            file_slices.append(slice(box_slice.start + start, box_slice.start + stop, step))
+        return np.asarray(self._proxy[tuple(file_slices) + key[3:]], dtype=self._dtype)
+
+    def __array__(self, dtype=None):
+        arr = self[()]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+def _mappable(data):
+    """
+    :return: True if the data's source file can be read directly in the same
+             layout as ``data.raw()``
+    """
+    fname = getattr(data, "fname", None)
+    if not fname or not os.path.isfile(fname) or getattr(data, "rawdata", None) is not None:
+        return False
+    try:
+        shape = nib.load(fname).shape
+    except Exception:
+        return False
+    expected = tuple(data.grid.shape)
+    if data.nvols > 1:
+        expected += (data.nvols,)
+    return tuple(shape) == expected
+
+def crop_data(data, slices, memory_map=False, dtype=None):
+    """
+    Get the image data within a bounding box
+
+    :param data: QpData instance
+    :param slices: Bounding box slices within the data grid
+    :param memory_map: If True, and the data comes straight from a NIfTI file
+                       which has not yet been loaded, return a ``MappedCrop``
+                       rather than loading the whole file
+    :param dtype: If given, convert the cropped data to a contiguous array of
+                  this type, so later stages can use it without further copies
+    :return: Array-like object supporting slicing, ``shape`` and ``ndim``
+    """
+    if memory_map and _mappable(data):
+        return MappedCrop(data.fname, slices, dtype)
+    if dtype is not None:
+        return np.ascontiguousarray(data.raw()[slices], dtype=dtype)
+    return data.raw()[slices]
+
+class ModalityStack(object):
+    """
+    Several co-registered data sets used together as the channels of one image
+
+    The data sets are never stacked on the full grid. ``crop`` copies the
+    bounding box of each one straight into its channels of a float32 array,
+    then normalises and weights the channels in place, so the only copy
+    held is the cropped stack.
+
+    Each data set is normalised separately, using the voxels in the mask:
+    ``range`` scales it to 0-1, ``zscore`` to zero mean and unit standard
+    deviation, and ``none`` leaves it unchanged. The channels of a 4D data
+    set are normalised together. Each data set is then multiplied by its
+    weight, so larger weights give it more influence on the clustering.
+    The offset, scale and weight applied to each data set by the last crop
+    are kept in ``transforms``.
+    """
+    def __init__(self, datas, normalisation="range", weights=None):
+        """
+        :param datas: Sequence of QpData instances on the same grid
+        :param normalisation: One of ``NORMALISATIONS``, or a list giving one for each data set
+        :param weights: List of weights for each data set, default all 1
+        """
+        if not datas:
+            raise QpException("Empty list given for data")
+        self.datas = list(datas)
+        self.grid = self.datas[0].grid
+        for data in self.datas[1:]:
+            if not data.grid.matches(self.grid):
+                raise QpException("Data %s is not on the same grid as %s" % (data.name, self.datas[0].name))
+
+        if isinstance(normalisation, (list, tuple)):
+            self.normalisation = list(normalisation)
+        else:
+            self.normalisation = [normalisation] * len(self.datas)
+        self.weights = [1.0] * len(self.datas) if weights is None else [float(w) for w in weights]
+        if len(self.normalisation) != len(self.datas) or len(self.weights) != len(self.datas):
+            raise QpException("Normalisation and weights must be given for each of %i data sets" % len(self.datas))
+        for method in self.normalisation:
+            if method not in NORMALISATIONS:
+                raise QpException("Unknown normalisation: %s (must be %s)" % (method, ", ".join(NORMALISATIONS)))
+
+        self.name = "+".join(data.name for data in self.datas)
+        self.nvols = sum(data.nvols for data in self.datas)
+        self.transforms = []
+
+    def crop(self, slices, mask, memory_map=False):
+        """
+        Cropped, normalised and weighted stack of the data sets
+
+        :param slices: Bounding box slices within the grid
+        :param mask: Cropped mask, used for the normalisation statistics
+        :param memory_map: Read each data set through a memory map, as for ``crop_data``
+        :return: float32 4D array with ``nvols`` channels
+        """
+        mask = np.asarray(mask) > 0
+        shape = tuple(s.stop - s.start for s in slices)
+        stack = np.empty(shape + (self.nvols,), dtype=np.float32)
+        self.transforms, start = [], 0
+        for data, method, weight in zip(self.datas, self.normalisation, self.weights):
+            channels = stack[..., start:start + data.nvols]
+            channels[...] = np.reshape(np.asarray(crop_data(data, slices, memory_map)), channels.shape)
+            start += data.nvols
+            offset, scale = 0.0, 1.0
+            values = channels[mask]
+            if method == "range" and values.size:
+                offset, scale = float(values.min()), float(values.max() - values.min())
+            elif method == "zscore" and values.size:
+                offset, scale = float(values.mean()), float(values.std())
+            channels -= offset
+            channels *= weight / max(scale, 1e-12)
+            self.transforms.append((offset, scale, weight))
+        return stack
@@ -0,0 +1,97 @@
+"""
+Quantiphyse - Summary statistics for supervoxel label volumes
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+def quality_metrics(labels, features):
+    """
+    Summary measures of how well supervoxels fit the features they were generated from
+
+    :param labels: Cropped labels, -1 outside the mask
+    :param features: Cropped feature volume with channels along the last axis
+    :return: Dictionary containing the number of supervoxels, the coefficient
+             of variation of their sizes, and the fraction of the total
+             feature variance within the mask which is not explained by the
+             supervoxel means
+    """
+    inside = labels >= 0
+    _, idx = np.unique(labels[inside], return_inverse=True)
+    counts = np.bincount(idx)
+    feats = np.asarray(features[inside], dtype=np.float64).reshape(idx.size, -1)
+
+    total_ss, within_ss = 0.0, 0.0
+    for chan in range(feats.shape[1]):
+        values = feats[:, chan]
+        sums = np.bincount(idx, weights=values)
+        total_ss += np.sum(values**2) - np.sum(values)**2 / max(values.size, 1)
+        within_ss += np.sum(np.bincount(idx, weights=values**2) - sums**2 / counts)
+
+    return {
+        "n_supervoxels" : len(counts),
+        "size_cv" : float(np.std(counts) / np.mean(counts)) if len(counts) else 0.0,
+        "unexplained_variance" : float(within_ss / total_ss) if total_ss > 0 else 0.0,
+    }
+
+def supervoxel_stats(labels, img, offset=(0, 0, 0)):
+    """
+    Statistics of the image data within each supervoxel
+
+    Each statistic is a segmented sum over the labelled voxels, so the cost
+    does not depend on the number of supervoxels. 4D data is read one volume
+    at a time.
+
+    :param labels: Cropped labels, -1 outside the mask
+    :param img: Cropped 3D or 4D image data, or any array-like object which can be
+                sliced one volume at a time
+    :param offset: Position of the crop within the full grid, added to the centroids
+    :return: Dictionary containing the supervoxel ``label`` (output ROI value, i.e.
+             one more than the label), ``voxels`` (count), ``centroid`` (N x 3 in
+             grid voxel coordinates), ``mean`` and ``std`` over all voxels and
+             timepoints, and ``timecourse`` (N x volumes mean timecourse, or None
+             for 3D data)
+    """
+    labels = np.asarray(labels)
+    inside = labels >= 0
+    values, idx = np.unique(labels[inside], return_inverse=True)
+    counts = np.bincount(idx).astype(np.double)
+    centroid = np.stack([np.bincount(idx, weights=coords) / counts + start
+                         for coords, start in zip(np.nonzero(inside), offset)], axis=1)
+
+    nvols = img.shape[3] if len(img.shape) > 3 else 1
+    sums = np.zeros((len(values), nvols))
+    sumsq = np.zeros((len(values), nvols))
+    for vol in range(nvols):
+        if len(img.shape) > 3:
+            vol_data = np.asarray(img[:, :, :, vol])[inside]
+        else:
+            vol_data = np.asarray(img)[inside]
+        vol_data = vol_data.astype(np.double)
+        sums[:, vol] = np.bincount(idx, weights=vol_data, minlength=len(values))
+        sumsq[:, vol] = np.bincount(idx, weights=vol_data**2, minlength=len(values))
+
+    n_values = counts * nvols
+    mean = sums.sum(axis=1) / n_values
+    var = np.clip(sumsq.sum(axis=1) / n_values - mean**2, 0, None)
+    return {
+        "label" : values + 1,
+        "voxels" : counts.astype(np.int64),
+        "centroid" : centroid,
+        "mean" : mean,
+        "std" : np.sqrt(var),
+        "timecourse" : sums / counts[:, np.newaxis] if nvols > 1 else None,
+    }
@@ -0,0 +1,89 @@
+"""
+Quantiphyse - Parameter sweeps for supervoxel generation
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import itertools
+import time
+
+from quantiphyse.utils import QpException
+
+from .parallel import run_jobs, slic_features_job
+from .features import smooth_features
+
+#: Options which can be given as lists of values to sweep over. Sigma is
+#: first so that combinations sharing the same smoothing are run together
+SWEEP_OPTIONS = ("sigma", "n-supervoxels", "compactness")
+
+def sweep_combinations(sweep, defaults):
+    """
+    Expand a sweep specification into a list of option combinations
+
+    :param sweep: Mapping from option name to a value or list of values
+    :param defaults: Values to use for options which are not swept
+    :return: List of dictionaries, one for each combination
+    """
+    unknown = set(sweep) - set(SWEEP_OPTIONS)
+    if unknown:
+        raise QpException("Options cannot be swept: %s" % ", ".join(sorted(unknown)))
+
+    values = []
+    for key in SWEEP_OPTIONS:
+        key_values = sweep.get(key, defaults[key])
+        if not isinstance(key_values, (list, tuple)):
+            key_values = [key_values]
+        if not key_values or None in key_values:
+            raise QpException("No values given for %s" % key)
+        values.append(key_values)
+    return [dict(zip(SWEEP_OPTIONS, combo)) for combo in itertools.product(*values)]
+
+def _sweep_job(slic_fn, features, mask, n_supervoxels, slic_kwargs):
+    start = time.time()
+    labels = slic_fn(features, mask, n_supervoxels, slic_kwargs)
+    return labels, time.time() - start
+
+def run_sweep(features, mask, combos, spacing, slic_kwargs, n_workers=1, slic_fn=slic_features_job,
+              smoothing="gaussian", threads=1):
+    """
+    Cluster a shared feature volume with each combination of sweep options
+
+    The features are smoothed once for each distinct sigma, just before the
+    first combination which needs them, and the clustering runs are spread
+    over a process pool.
+
+    :param features: Unsmoothed feature volume from ``features.preprocess``
+    :param mask: Cropped mask
+    :param combos: Option combinations from ``sweep_combinations``
+    :param spacing: Voxel spacing
+    :param slic_kwargs: Other keyword arguments for clustering
+    :param n_workers: Number of combinations to run in parallel
+    :param slic_fn: Picklable job function used to cluster the features
+    :param smoothing: Smoothing method, as for ``features.smooth_features``
+    :param threads: Number of channels to smooth in parallel
+    :return: Generator of (combination index, labels, clustering time in seconds)
+             in completion order
+    """
+    def _jobs():
+        current_sigma, smoothed = None, None
+        for combo in combos:
+            if smoothed is None or combo["sigma"] != current_sigma:
+                current_sigma = combo["sigma"]
+                smoothed = smooth_features(features, current_sigma, spacing, smoothing, threads)
+            kwargs = dict(slic_kwargs, compactness=combo["compactness"], sigma=0)
+            yield slic_fn, smoothed, mask, combo["n-supervoxels"], kwargs
+
+    for idx, (labels, elapsed) in run_jobs(_sweep_job, _jobs(), n_workers):
+        yield idx, labels, elapsed
@@ -15,14 +15,47 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import gc
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest 
 
 import numpy as np
+import nibabel as nib
 
+from scipy.ndimage import binary_dilation, label as connected_label
+import maskslic
+from maskslic.perfslic import preprocess_pca
+
+from quantiphyse.data import DataGrid, NumpyData
 from quantiphyse.processes import Process
 from quantiphyse.test import WidgetTest, ProcessTest
+from quantiphyse.utils import QpException
 
 from .widgets import PerfSlicWidget
+from .labels import assemble_labels, compact_labels, save_labels, load_labels, load_roi
+from .parallel import perfslic_job
+from .features import pca_features, streaming_pca, preprocess, smooth_features, box_widths, modality_features
+from .source import MappedCrop, crop_data, ModalityStack
+from .cache import FeatureCache, FEATURE_CACHE, ResultCache, content_hash
+from .profiling import StageProfiler
+from .benchmark import synthetic_data, benchmark_cases, run_benchmarks, compare, label_agreement, _peak_memory
+from .benchmark import thread_scaling
+from .batch import run_batch, load_batch, case_memory
+from .tiling import bytes_per_voxel, data_itemsize
+from .incremental import incremental_slic
+from .warmstart import warm_slic, seed_step
+from .stats import supervoxel_stats
+from .adjacency import adjacent_pairs, feature_distances, adjacency_matrix, save_adjacency, load_adjacency
+from .pyramid import pyramid_factors, downsample, upsample_labels, pyramid_slic, coarse_slic, fit_factor
+from .cleanup import connected_fragments, cleanup_labels
+from .engines import get_engine, engine_names
+from .numpyslic import numpy_slic, numpy_perfslic_job, _slabs
+from .process import SupervoxelsProcess, SupervoxelsJob
 
 NUM_SV = 4
 NAME = "test_sv"
@@ -35,6 +68,20 @@ class PerfSlicWidgetTest(WidgetTest):
     def widget_class(self):
         return PerfSlicWidget
 
+    def tearDown(self):
+        WidgetTest.tearDown(self)
+        # The widget and its run box refer to each other, so free them now rather than
+        # in the middle of a later test
+        gc.collect()
+
+    def wait_for_run(self, timeout=60):
+        """ Generation runs in the background, so wait until the generate button is re-enabled """
+        start = time.time()
+        while not self.w.gen_btn.isEnabled() and time.time() - start < timeout:
+            self.processEvents()
+            time.sleep(0.05)
+        self.processEvents()
+
     def testNoData(self):
         """ User clicks the generate buttons with no data"""
         self.harmless_click(self.w.gen_btn)
@@ -51,7 +98,7 @@ class PerfSlicWidgetTest(WidgetTest):
         self.w.output_name.setText(NAME)
 
         self.harmless_click(self.w.gen_btn)
-        self.processEvents()
+        self.wait_for_run()
 
         self.assertTrue(NAME in self.ivm.rois)
         self.assertEquals(self.ivm.current_roi.name, NAME)
@@ -70,6 +117,27 @@ class PerfSlicWidgetTest(WidgetTest):
         self.assertTrue(np.all(sv[self.mask == 0] == 0))
         self.assertFalse(self.error)
 
+    def test3dDataMaskThreads(self):
+        self.w.threads.spin.setValue(2)
+        self.test3dDataMask()
+
+    def testBatchOptions(self):
+        self.ivm.add(self.data_3d, grid=self.grid, name="data_3d")
+        self.w.ovl.setCurrentIndex(0)
+        self.processEvents()
+        options = self.w.batch_options()[1]
+        for key in ("feature-cache", "stats", "threads", "smoothing", "engine"):
+            self.assertFalse(key in options)
+        self.assertTrue(self.w.processes()["Supervoxels"]["feature-cache"])
+
+        self.w.threads.spin.setValue(4)
+        self.w.box_smoothing.setChecked(True)
+        self.w.engine.setCurrentIndex(self.w.engine.findText("numpy"))
+        options = self.w.batch_options()[1]
+        self.assertEqual(options["threads"], 4)
+        self.assertEqual(options["smoothing"], "box")
+        self.assertEqual(options["engine"], "numpy")
+
     def test4dData(self):
         self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
         self.w.ovl.setCurrentIndex(0)
@@ -84,7 +152,7 @@ class PerfSlicWidgetTest(WidgetTest):
         self.w.output_name.setText(NAME)
 
         self.harmless_click(self.w.gen_btn)
-        self.processEvents()
+        self.wait_for_run()
 
         self.assertTrue(NAME in self.ivm.rois)
         self.assertEquals(self.ivm.current_roi.name, NAME)
@@ -104,8 +172,67 @@ class PerfSlicWidgetTest(WidgetTest):
         self.assertTrue(np.all(sv[self.mask == 0] == 0))
         self.assertFalse(self.error)
 
+    def wait_for_preview(self, timeout=60):
+        """ Wait for the debounce timer and any running preview to finish """
+        start = time.time()
+        while ((self.w._preview_timer.isActive() or self.w._preview_process is not None)
+               and time.time() - start < timeout):
+            self.processEvents()
+            time.sleep(0.05)
+        self.processEvents()
+
+    def testPreview(self):
+        self.ivm.add(self.data_4d, grid=self.grid, name="data_4d")
+        self.ivm.add(self.mask, grid=self.grid, name="mask", roi=True)
+        self.w.ovl.setCurrentIndex(0)
+        self.w.roi.setCurrentIndex(0)
+        self.w.output_name.setText(NAME)
+        self.w.n_supervoxels.spin.setValue(NUM_SV)
+        self.processEvents()
+
+        self.w.preview.setChecked(True)
+        # Several quick changes only lead to one preview run
+        self.w.compactness.spin.setValue(COMP)
+        self.w.sigma.spin.setValue(SIGMA)
+        self.assertTrue(self.w._preview_timer.isActive())
+        self.wait_for_preview()
+        preview = NAME + "_preview"
+        self.assertTrue(preview in self.ivm.rois)
+        self.assertFalse(NAME in self.ivm.rois)
+        sv = self.ivm.rois[preview].raw()
+        self.assertTrue(np.all(sv[self.mask == 0] == 0))
+        # The preview is not made current or offered as a clustering ROI
+        self.assertEquals(self.ivm.current_roi.name, "mask")
+        self.assertEquals(self.w.roi.findText(preview), -1)
+        self.assertEquals(self.w.roi.currentText(), "mask")
+
+        # A full resolution run replaces the preview
+        self.harmless_click(self.w.gen_btn)
+        self.wait_for_run()
+        self.assertFalse(preview in self.ivm.rois)
+        self.assertTrue(NAME in self.ivm.rois)
+
+        self.w.preview.setChecked(False)
+        self.w.n_supervoxels.spin.setValue(NUM_SV + 1)
+        self.assertFalse(self.w._preview_timer.isActive())
+        self.assertFalse(self.error)
+
 class SupervoxelsProcessTest(ProcessTest):
 
+    def run_labels(self, yaml, name):
+        """
+        Run a script which should succeed and check the supervoxel ROI it
+        creates is zero outside the mask
+
+        :return: Label volume of the ROI
+        """
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue(name in self.ivm.rois)
+        sv = self.ivm.rois[name].raw()
+        self.assertTrue(np.all(sv[self.mask == 0] == 0))
+        return sv
+
     def test3d(self):
         yaml = """
   - Supervoxels:
@@ -132,5 +259,1257 @@ class SupervoxelsProcessTest(ProcessTest):
         self.assertEqual(self.status, Process.SUCCEEDED)
         self.assertTrue("sv_4d" in self.ivm.rois)
 
+    def test3dTiled(self):
+        yaml = """
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_tiled
+      compactness: 0.01
+      n-supervoxels: 20
+      tiled: True
+      tile-memory: 0.05
+      tile-overlap: 2
+"""
+        sv = self.run_labels(yaml, "sv_tiled")
+        self.assertTrue("tile-memory only bounds memory use when memory-map" in self.log)
+        self.assertTrue(np.all(sv[self.mask > 0] > 0))
+
+    def test3dPerRegion(self):
+        yaml = """
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_regions
+      compactness: 0.01
+      n-supervoxels: 20
+      per-region: True
+      n-workers: 2
+"""
+        sv = self.run_labels(yaml, "sv_regions")
+        # No supervoxel crosses a region boundary
+        for label in np.unique(sv[sv > 0]):
+            self.assertEqual(len(np.unique(self.mask[sv == label])), 1)
+
+    def test4dStreamingPca(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_pca
+      n-components: 3
+      compactness: 0.02
+      n-supervoxels: 30
+      streaming-pca: True
+      pca-batch: 2
+"""
+        self.run_labels(yaml, "sv_pca")
+
+    def test4dMemoryMap(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_mmap
+      n-components: 3
+      compactness: 0.02
+      n-supervoxels: 30
+      memory-map: True
+      streaming-pca: True
+"""
+        self.run_labels(yaml, "sv_mmap")
+
+    def test4dFeatureCache(self):
+        FEATURE_CACHE.clear()
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_nocache
+      n-components: 3
+      compactness: 0.02
+      sigma: 0.5
+      n-supervoxels: 30
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_cache
+      n-components: 3
+      compactness: 0.02
+      sigma: 0.5
+      n-supervoxels: 30
+      feature-cache: True
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_cache2
+      n-components: 3
+      compactness: 0.05
+      sigma: 0.5
+      n-supervoxels: 20
+      feature-cache: True
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue(np.all(self.ivm.rois["sv_cache"].raw() == self.ivm.rois["sv_nocache"].raw()))
+        self.assertTrue("sv_cache2" in self.ivm.rois)
+        self.assertEqual(len(FEATURE_CACHE), 1)
+
+    def testFeatureCacheLabels(self):
+        # Features from the cache must give the same labels as perfslic's own preprocessing
+        for data in ("data_3d", "data_4d"):
+            FEATURE_CACHE.clear()
+            yaml = """
+  - Supervoxels:
+      data: %s
+      roi: mask
+      output-name: sv_nocache
+      sigma: 1.0
+      n-supervoxels: 20
+
+  - Supervoxels:
+      data: %s
+      roi: mask
+      output-name: sv_miss
+      sigma: 1.0
+      n-supervoxels: 20
+      feature-cache: True
+
+  - Supervoxels:
+      data: %s
+      roi: mask
+      output-name: sv_hit
+      sigma: 1.0
+      n-supervoxels: 20
+      feature-cache: True
+""" % (data, data, data)
+            self.run_yaml(yaml)
+            self.assertEqual(self.status, Process.SUCCEEDED)
+            self.assertTrue("Using cached features" in self.log)
+            nocache = self.ivm.rois["sv_nocache"].raw()
+            self.assertTrue(np.all(self.ivm.rois["sv_miss"].raw() == nocache))
+            self.assertTrue(np.all(self.ivm.rois["sv_hit"].raw() == nocache))
+
+    def test3dSweep(self):
+        yaml = """
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_sweep
+      compactness: 0.01
+      n-workers: 2
+      sweep:
+        n-supervoxels: [5, 10]
+        compactness: [0.01, 0.1]
+        sigma: [0, 0.5]
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        for idx in range(8):
+            self.assertTrue("sv_sweep_%i" % (idx + 1) in self.ivm.rois)
+            sv = self.ivm.rois["sv_sweep_%i" % (idx + 1)].raw()
+            self.assertTrue(np.all(sv[self.mask == 0] == 0))
+        self.assertTrue("sv_sweep_sweep" in self.ivm.extras)
+        table = self.ivm.extras["sv_sweep_sweep"]
+        self.assertEqual(len(table.arr), 8)
+        self.assertEqual([row[1] for row in table.arr], [5, 5, 10, 10] * 2)
+
+    def test4dProfile(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_profile
+      n-components: 3
+      compactness: 0.02
+      n-supervoxels: 30
+      profile-file: sv_profile.json
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue("sv_profile" in self.ivm.rois)
+        self.assertTrue("sv_profile_profile" in self.ivm.extras)
+        stages = [row[0] for row in self.ivm.extras["sv_profile_profile"].arr]
+        self.assertEqual(stages, ["Load data", "Crop", "Clustering", "Assemble output"])
+        with open(os.path.join(self.output_dir, "case", "sv_profile.json")) as json_file:
+            report = json.load(json_file)
+        self.assertEqual([stage["stage"] for stage in report["stages"]], stages)
+        self.assertTrue(all(stage["peak_memory"] is not None for stage in report["stages"]))
+
+    def test3dCancel(self):
+        self.ivm.add(self.data_3d, grid=self.grid, name="data_3d")
+        self.ivm.add(self.mask, grid=self.grid, name="mask", roi=True)
+        process = SupervoxelsProcess(self.ivm)
+        finished = []
+        process.sig_finished.connect(lambda status, log, exc: finished.append(status))
+
+        process.execute({"data" : "data_3d", "roi" : "mask", "n-supervoxels" : 10, "stats" : True})
+        self.assertEqual(process.status, Process.RUNNING)
+        process.cancel()
+        self.assertEqual(finished, [Process.CANCELLED])
+
+        # The worker's result is ignored when it arrives
+        for _ in range(5):
+            self.processEvents()
+            time.sleep(1)
+        self.assertEqual(process.status, Process.CANCELLED)
+        self.assertFalse("supervoxels" in self.ivm.rois)
+
+        # The worker itself stops at the next stage once cancelled
+        job = SupervoxelsJob({})
+        job.cancel_event = threading.Event()
+        job.cancel_event.set()
+        def _stage():
+            with job.stage("Clustering"):
+                pass
+        self.assertRaises(QpException, _stage)
+
+    def test4dIncremental(self):
+        # The edited ROI gains a few voxels next to the original one
+        mask = self.mask.copy()
+        inside = np.argwhere(mask > 0)
+        corner = inside.min(axis=0)
+        mask[corner[0] - 1, corner[1]:corner[1] + 2, corner[2]:corner[2] + 2] = 1
+        self.ivm.add(mask, grid=self.grid, name="mask_edit", roi=True)
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_before
+      n-supervoxels: 6
+      compactness: 0.05
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask_edit
+      previous: sv_before
+      output-name: sv_after
+      compactness: 0.05
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        before, after = self.ivm.rois["sv_before"].raw(), self.ivm.rois["sv_after"].raw()
+        self.assertTrue(np.all((after > 0) == (mask > 0)))
+        self.assertTrue("Reclustered" in self.log)
+        # Supervoxels away from the edit keep their labels
+        self.assertTrue(np.any((before > 0) & (after == before)))
+
+    def test4dWarmStart(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_cold
+      n-supervoxels: 6
+      compactness: 0.05
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      initial-labels: sv_cold
+      output-name: sv_warm
+      compactness: 0.08
+      convergence-tol: 0.02
+"""
+        sv = self.run_labels(yaml, "sv_warm")
+        self.assertTrue("Warm start took" in self.log)
+        self.assertTrue(np.all((sv > 0) == (self.mask > 0)))
+
+    def test4dPyramid(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_pyramid
+      n-supervoxels: 6
+      compactness: 0.05
+      pyramid: True
+      pyramid-iterations: 2
+"""
+        sv = self.run_labels(yaml, "sv_pyramid")
+        self.assertTrue(np.all((sv > 0) == (self.mask > 0)))
+        self.assertTrue(len(np.unique(sv[sv > 0])) > 1)
+
+    def test4dStats(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_stats
+      n-supervoxels: 6
+      compactness: 0.05
+      stats: True
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        sv = self.ivm.rois["sv_stats"]
+        table = self.ivm.extras["sv_stats_stats"]
+        self.assertEqual([row[0] for row in table.arr], list(sv.regions.keys()))
+        self.assertEqual(sum(row[1] for row in table.arr), np.count_nonzero(sv.raw()))
+        # Unit voxel size, so volume equals the number of voxels
+        self.assertEqual(table.arr[0][2], table.arr[0][1])
+        timecourses = self.ivm.extras["sv_stats_timecourses"]
+        self.assertEqual(len(timecourses.arr), len(table.arr))
+        self.assertEqual(len(timecourses.arr[0]), self.data_4d.shape[3])
+
+    def test4dAdjacency(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_adj
+      n-supervoxels: 6
+      compactness: 0.05
+      adjacency: True
+"""
+        sv = self.run_labels(yaml, "sv_adj")
+        table = self.ivm.extras["sv_adj_adjacency"].arr
+        self.assertTrue(len(table) > 0)
+        for first, second, count, _ in table:
+            self.assertTrue(first < second)
+            near = binary_dilation(sv == first) & (sv == second)
+            self.assertTrue(np.count_nonzero(near) > 0)
+        self.assertTrue("sv_adj_stats" not in self.ivm.extras)
+
+    def test3dCompactFile(self):
+        yaml = """
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_compact
+      n-supervoxels: 5
+      compact-file: sv_compact.npz
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        loaded, _ = load_labels(os.path.join(self.output_dir, "case", "sv_compact.npz"))
+        self.assertTrue(np.all(loaded == self.ivm.rois["sv_compact"].raw()))
+
+    def test4dResultCache(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_cache1
+      n-supervoxels: 6
+      compactness: 0.05
+      cache-dir: cache
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_cache2
+      n-supervoxels: 6
+      compactness: 0.05
+      cache-dir: cache
+      stats: True
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_cache3
+      n-supervoxels: 6
+      compactness: 0.1
+      cache-dir: cache
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        # Output name and statistics do not affect the result, other options do
+        self.assertEqual(self.log.count("Using cached result"), 1)
+        self.assertTrue(np.all(self.ivm.rois["sv_cache1"].raw() == self.ivm.rois["sv_cache2"].raw()))
+        self.assertTrue("sv_cache2_stats" in self.ivm.extras)
+        self.assertEqual(len(os.listdir(os.path.join(self.output_dir, "case", "cache"))), 2)
+
+        # Data with different content does not match
+        self.ivm.add(self.data_4d + 1, grid=self.grid, name="data_shifted")
+        self.run_yaml(yaml.replace("data_4d", "data_shifted"))
+        self.assertEqual(self.log.count("Using cached result"), 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.output_dir, "case", "cache"))), 4)
+
+    def test3dCleanup(self):
+        yaml = """
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_clean
+      n-supervoxels: 8
+      compactness: 0.01
+      cleanup: True
+"""
+        sv = self.run_labels(yaml, "sv_clean")
+        self.assertTrue("Merged" in self.log)
+        self.assertTrue(np.all((sv > 0) == (self.mask > 0)))
+        values = np.unique(sv[sv > 0])
+        self.assertEqual(values.tolist(), list(range(1, len(values) + 1)))
+        for value in values:
+            self.assertEqual(connected_label(sv == value)[1], 1)
+
+    def test4dEngines(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_maskslic
+      n-supervoxels: 6
+      compactness: 0.05
+      engine: maskslic
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_numpy
+      n-supervoxels: 6
+      compactness: 0.05
+      engine: numpy
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue(np.all(self.ivm.rois["sv_maskslic"].raw() == self.ivm.rois["sv_numpy"].raw()))
+
+    def test3dThreads(self):
+        yaml = """
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_serial
+      n-supervoxels: 8
+      compactness: 0.05
+      feature-cache: True
+
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_threads
+      n-supervoxels: 8
+      compactness: 0.05
+      feature-cache: True
+      threads: 3
+
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_numpy_threads
+      n-supervoxels: 8
+      compactness: 0.05
+      feature-cache: True
+      engine: numpy
+      threads: 3
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        # Threads do not change the engine, and only change how the work is split
+        for name in ("sv_threads", "sv_numpy_threads"):
+            self.assertTrue(np.all(self.ivm.rois["sv_serial"].raw() == self.ivm.rois[name].raw()))
+        # Only the single threaded engine warns that threads are not used for clustering
+        self.assertEqual(self.log.count("clusters on a single thread"), 1)
+
+    def test4dPrecision(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_float64
+      n-supervoxels: 6
+      compactness: 0.05
+      streaming-pca: True
+      precision: float64
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_float32
+      n-supervoxels: 6
+      compactness: 0.05
+      streaming-pca: True
+      precision: float32
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_float16
+      n-supervoxels: 6
+      precision: float16
+"""
+        self.run_yaml(yaml)
+        _, matched = label_agreement(self.ivm.rois["sv_float32"].raw(), self.ivm.rois["sv_float64"].raw())
+        self.assertTrue(matched > 0.95)
+        self.assertTrue("Unknown precision" in self.log)
+        self.assertFalse("sv_float16" in self.ivm.rois)
+
+    def test4dSmoothing(self):
+        yaml = """
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_gaussian
+      n-supervoxels: 6
+      compactness: 0.05
+      sigma: 2.5
+      feature-cache: True
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_box
+      n-supervoxels: 6
+      compactness: 0.05
+      sigma: 2.5
+      feature-cache: True
+      smoothing: box
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_box_nocache
+      n-supervoxels: 6
+      compactness: 0.05
+      sigma: 2.5
+      smoothing: box
+
+  - Supervoxels:
+      data: data_4d
+      roi: mask
+      output-name: sv_median
+      n-supervoxels: 6
+      sigma: 2.5
+      smoothing: median
+"""
+        self.run_yaml(yaml)
+        # Kernels this narrow are smoothed with the Gaussian filter, so the labels do not change
+        self.assertTrue(np.all(self.ivm.rois["sv_box"].raw() == self.ivm.rois["sv_gaussian"].raw()))
+        # Box smoothing is done by the plugin even without the feature cache
+        self.assertTrue(np.all(self.ivm.rois["sv_box_nocache"].raw() == self.ivm.rois["sv_box"].raw()))
+        self.assertTrue("Unknown smoothing method" in self.log)
+
+    def testMultiModal(self):
+        yaml = """
+  - Supervoxels:
+      data: [data_3d, data_4d]
+      roi: mask
+      output-name: sv_multi
+      n-supervoxels: 6
+      compactness: 0.05
+      n-components: 2
+      sigma: 1
+      weights: [2, 1]
+      feature-cache: True
+
+  - Supervoxels:
+      data: [data_3d, data_4d]
+      roi: mask
+      output-name: sv_multi_cached
+      n-supervoxels: 6
+      compactness: 0.05
+      n-components: 2
+      sigma: 1
+      weights: [2, 1]
+      feature-cache: True
+
+  - Supervoxels:
+      data: [data_3d, data_4d]
+      roi: mask
+      output-name: sv_multi_nocache
+      n-supervoxels: 6
+      compactness: 0.05
+      n-components: 2
+      sigma: 1
+      weights: [2, 1]
+
+  - Supervoxels:
+      data: data_3d
+      roi: mask
+      output-name: sv_single_weights
+      n-supervoxels: 6
+      weights: [2, 1]
+"""
+        labels = self.run_labels(yaml, "sv_multi")
+        self.assertTrue(np.all((labels > 0) == (self.mask > 0)))
+        self.assertTrue(len(np.unique(labels[labels > 0])) > 1)
+        # Same data and ROI reuses the features, and without the cache they are recomputed the same way
+        self.assertEqual(self.log.count("Using cached features"), 1)
+        self.assertTrue(np.all(self.ivm.rois["sv_multi_cached"].raw() == labels))
+        self.assertTrue(np.all(self.ivm.rois["sv_multi_nocache"].raw() == labels))
+        self.assertTrue("Weights can only be given with a list of data" in self.log)
+
+class LabelsTest(unittest.TestCase):
+
+    def testAssembleLabels(self):
+        labels = -np.ones((4, 5, 6), dtype=np.int32)
+        labels[1:3, 1:4, 2:5] = np.arange(18).reshape((2, 3, 3))
+        slices = (slice(2, 6), slice(0, 5), slice(3, 9))
+        newroi, saved = assemble_labels(labels, slices, (10, 10, 10))
+        self.assertEqual(newroi.dtype, np.uint8)
+        self.assertEqual(newroi.shape, (10, 10, 10))
+        self.assertEqual(np.count_nonzero(newroi), 18)
+        self.assertTrue(np.all(newroi[slices] == labels + 1))
+        self.assertEqual(saved, 1000 * (4 - 1))
+
+    def testAssembleLabelsManyLabels(self):
+        labels = np.arange(1000, dtype=np.int32).reshape((10, 10, 10))
+        newroi, _ = assemble_labels(labels, (slice(0, 10),) * 3, (10, 10, 10))
+        self.assertEqual(newroi.dtype, np.uint16)
+        self.assertEqual(newroi.max(), 1000)
+
+    def testCompactLabels(self):
+        roi = np.zeros((10, 12, 14), dtype=np.int32)
+        roi[2:5, 3:9, 4:6] = np.arange(36).reshape((3, 6, 2)) + 1
+        offset, cropped = compact_labels(roi)
+        self.assertEqual(offset, (2, 3, 4))
+        self.assertEqual(cropped.shape, (3, 6, 2))
+        self.assertEqual(cropped.dtype, np.uint8)
+
+        affine = np.diag([2, 2, 3, 1])
+        tempdir = tempfile.mkdtemp("_qp_sv")
+        try:
+            fname = os.path.join(tempdir, "sv.npz")
+            save_labels(fname, cropped, offset, roi.shape, affine)
+            loaded, loaded_affine = load_labels(fname)
+            qpdata = load_roi(fname, name="sv")
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertTrue(np.all(loaded == roi))
+        self.assertTrue(np.all(loaded_affine == affine))
+        self.assertTrue(qpdata.roi)
+        self.assertTrue(np.all(qpdata.grid.affine == affine))
+        self.assertTrue(np.all(qpdata.raw() == roi))
+
+    def testCompactEmpty(self):
+        offset, cropped = compact_labels(np.zeros((3, 4, 5)))
+        self.assertEqual(cropped.size, 0)
+
+class FeaturesTest(unittest.TestCase):
+
+    def testStreamingPcaMatchesPerfslic(self):
+        np.random.seed(1)
+        img = 100 * np.random.normal(size=(6, 7, 9, 12)) + 1000
+        features = streaming_pca(img, 3, batch=2)
+        self.assertEqual(features.shape, (6, 7, 9, 3))
+        self.assertEqual(features.dtype, np.float32)
+
+        expected = preprocess_pca(img, 3)
+        # Components are only defined up to sign
+        for comp in range(3):
+            actual = features[..., comp]
+            self.assertTrue(np.allclose(actual, expected[..., comp], atol=5e-3) or
+                            np.allclose(actual, 1 - expected[..., comp], atol=5e-3))
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="qp")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testContentHash(self):
+        arr = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+        key = content_hash([arr], {"a" : 1, "b" : [1, 2]})
+        self.assertEqual(key, content_hash([arr.copy()], {"b" : [1, 2], "a" : 1}))
+        self.assertNotEqual(key, content_hash([arr], {"a" : 2, "b" : [1, 2]}))
+        self.assertNotEqual(key, content_hash([arr.astype(np.float64)], {"a" : 1, "b" : [1, 2]}))
+        self.assertNotEqual(key, content_hash([arr.reshape((3, 2, 4))], {"a" : 1, "b" : [1, 2]}))
+        arr4d = np.zeros((2, 3, 4, 2))
+        self.assertNotEqual(content_hash([arr4d], {}), content_hash([arr4d[..., :1]], {}))
+
+    def testPutGetEvict(self):
+        cache = ResultCache(os.path.join(self.tempdir, "cache"), max_bytes=1000000)
+        self.assertTrue(cache.get("a") is None)
+        labels = np.arange(1000, dtype=np.uint16).reshape((10, 10, 10))
+        cache.put("a", labels)
+        self.assertTrue(np.all(cache.get("a") == labels))
+
+        size = os.path.getsize(os.path.join(cache.directory, "a.npz"))
+        cache.max_bytes = int(size * 2.5)
+        os.utime(os.path.join(cache.directory, "a.npz"), (1, 1))
+        cache.put("b", labels)
+        cache.put("c", labels)
+        # The least recently used entry goes first
+        self.assertTrue(cache.get("a") is None)
+        self.assertTrue(cache.get("b") is not None)
+        self.assertEqual(sorted(os.listdir(cache.directory)), ["b.npz", "c.npz"])
+
+class SourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="qp")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testMappedCrop(self):
+        data = np.random.normal(size=(8, 9, 10, 5))
+        fname = os.path.join(self.tempdir, "data.nii")
+        nib.Nifti1Image(data, np.identity(4)).to_filename(fname)
+        box = (slice(2, 7), slice(1, 9), slice(3, 8))
+        crop = MappedCrop(fname, box)
+        self.assertEqual(crop.shape, (5, 8, 5, 5))
+        self.assertEqual(crop.ndim, 4)
+        self.assertTrue(np.allclose(np.asarray(crop), data[box]))
+        slab = (slice(None), slice(None), slice(1, 3))
+        self.assertTrue(np.allclose(crop[slab], data[box][slab]))
+
+    def testItemsize(self):
+        # Tile budgets are sized from the values as they will be read
+        fname = os.path.join(self.tempdir, "data.nii")
+        nib.Nifti1Image(np.zeros((6, 6, 6, 4), dtype=np.float32), np.identity(4)).to_filename(fname)
+        box = (slice(0, 4), slice(0, 4), slice(0, 4))
+        self.assertEqual(data_itemsize(MappedCrop(fname, box)), 4)
+        self.assertEqual(data_itemsize(MappedCrop(fname, box, np.float64)), 8)
+        self.assertEqual(data_itemsize(np.zeros((4, 4, 4), dtype=np.int16)), 2)
+        self.assertEqual(bytes_per_voxel(4, 3, 8) - bytes_per_voxel(4, 3, 4), 16)
+        self.assertEqual(case_memory({"data" : fname}, {}), 216 * bytes_per_voxel(4, 3, 4))
+        self.assertEqual(case_memory({"data" : fname}, {"precision" : "float64"}), 216 * bytes_per_voxel(4, 3, 8))
+
+class FeatureCacheTest(unittest.TestCase):
+
+    class Source(object):
+        pass
+
+    def testLruEviction(self):
+        cache = FeatureCache(max_bytes=250)
+        source = self.Source()
+        cache.put("a", source, np.zeros(100, dtype=np.uint8))
+        cache.put("b", source, np.zeros(100, dtype=np.uint8))
+        self.assertTrue(cache.get("a", source) is not None)
+        cache.put("c", source, np.zeros(100, dtype=np.uint8))
+        self.assertTrue(cache.get("b", source) is None)
+        self.assertTrue(cache.get("a", source) is not None)
+        self.assertTrue(cache.get("c", source) is not None)
+        self.assertEqual(cache.nbytes, 200)
+
+    def testReplacedSource(self):
+        cache = FeatureCache()
+        cache.put("a", self.Source(), np.zeros(10))
+        self.assertTrue(cache.get("a", self.Source()) is None)
+        self.assertEqual(len(cache), 0)
+
+    def testTooLarge(self):
+        cache = FeatureCache(max_bytes=10)
+        source = self.Source()
+        cache.put("a", source, np.zeros(100))
+        self.assertTrue(cache.get("a", source) is None)
+
+    def testThreads(self):
+        cache = FeatureCache(max_bytes=1000)
+        sources = [self.Source() for _ in range(4)]
+
+        def _worker(source):
+            for idx in range(500):
+                cache.put(idx % 20, source, np.zeros(100, dtype=np.uint8))
+                cache.get((idx + 7) % 20, source)
+
+        threads = [threading.Thread(target=_worker, args=(source,)) for source in sources]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.nbytes, 100 * len(cache))
+        self.assertTrue(cache.nbytes <= 1000)
+
+    def testMultipleSources(self):
+        cache = FeatureCache()
+        first, second = self.Source(), self.Source()
+        cache.put("a", (first, second), np.zeros(10))
+        self.assertTrue(cache.get("a", (first, second)) is not None)
+        self.assertTrue(cache.get("a", (first, self.Source())) is None)
+        self.assertEqual(len(cache), 0)
+
+class StageProfilerTest(unittest.TestCase):
+
+    def testStages(self):
+        profiler = StageProfiler(trace_memory=True)
+        with profiler.stage("alloc") as record:
+            arr = np.ones(1024 * 1024)
+        del arr
+        with profiler.stage("none"):
+            pass
+        self.assertEqual([row[0] for row in profiler.rows()], ["alloc", "none"])
+        self.assertTrue(record["peak_memory"] >= 8 * 1024 * 1024)
+        self.assertTrue(profiler.stages[1]["peak_memory"] < 1024 * 1024)
+        self.assertAlmostEqual(profiler.total_time(), sum(r["time"] for r in profiler.stages))
+
+    def testNoMemoryTracing(self):
+        profiler = StageProfiler()
+        with profiler.stage("stage"):
+            pass
+        self.assertEqual(profiler.stages[0]["peak_memory"], None)
+        self.assertEqual(profiler.rows()[0][2], "")
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testSyntheticData(self):
+        img, mask = synthetic_data(20, 5, 0.25)
+        self.assertEqual(img.shape, (20, 20, 20, 5))
+        self.assertAlmostEqual(float(np.count_nonzero(mask)) / mask.size, 0.25, places=2)
+
+    def testCases(self):
+        cases = benchmark_cases(sizes=(64, 512), nvols=(1, 200), fills=(0.5,),
+                                n_supervoxels=(10,), n_components=(2, 3), max_memory=1024)
+        self.assertEqual(cases, [(64, 1, 0.5, 10, 2), (64, 200, 0.5, 10, 2), (64, 200, 0.5, 10, 3),
+                                 (512, 1, 0.5, 10, 2)])
+
+    def testRunAndCompare(self):
+        report = run_benchmarks([(16, 1, 0.3, 5, 3), (16, 4, 0.3, 5, 2)])
+        self.assertEqual(len(report["results"]), 2)
+        for result in report["results"]:
+            self.assertTrue(result["time"] > 0)
+            self.assertTrue(result["n_output"] > 0)
+            self.assertTrue("peak_memory" in result)
+        ratios = compare(report, report)
+        self.assertEqual(len(ratios), 2)
+        self.assertTrue(all(time_ratio == 1 and mem_ratio == 1 for _, time_ratio, mem_ratio in ratios))
+
+    def testThreadScaling(self):
+        result = thread_scaling(16, 1, 0.3, 5, 3, threads=(1, 2))
+        self.assertTrue(result["maskslic"] > 0)
+        self.assertEqual([threads for threads, _ in result["numpy"]], [1, 2])
+        self.assertTrue(all(elapsed > 0 for _, elapsed in result["numpy"]))
+
+    def testPeakMemory(self):
+        # Stages without a memory measurement have an empty peak
+        self.assertEqual(_peak_memory([["Load data", 0.1, ""], ["Clustering", 1.0, 12.5], ["Crop", 0.1, 3.0]]), 12.5)
+        self.assertTrue(_peak_memory([["Load data", 0.1, ""]]) is None)
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="qp")
+        affine = np.identity(4)
+        for subject in range(3):
+            img, mask = synthetic_data(16, 4, 0.3, seed=subject)
+            nib.save(nib.Nifti1Image(img, affine), os.path.join(self.tempdir, "data%i.nii.gz" % subject))
+            nib.save(nib.Nifti1Image(mask, affine), os.path.join(self.tempdir, "mask%i.nii.gz" % subject))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _cases(self):
+        cases = [{"data" : os.path.join(self.tempdir, "data%i.nii.gz" % subject),
+                  "roi" : os.path.join(self.tempdir, "mask%i.nii.gz" % subject),
+                  "output" : os.path.join(self.tempdir, "out", "sv%i.nii.gz" % subject)}
+                 for subject in range(3)]
+        cases[1]["output"] = os.path.join(self.tempdir, "out", "sv1.npz")
+        cases[2]["n-supervoxels"] = 3
+        cases.append({"data" : os.path.join(self.tempdir, "missing.nii.gz"),
+                      "output" : os.path.join(self.tempdir, "out", "missing.nii.gz")})
+        return cases
+
+    def _check(self, cases, results):
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+        self.assertFalse(results[3][0])
+        for idx in range(3):
+            success, result = results[idx]
+            self.assertTrue(success)
+            self.assertTrue(os.path.exists(cases[idx]["output"]))
+            if cases[idx]["output"].endswith(".npz"):
+                sv = load_labels(cases[idx]["output"])[0]
+            else:
+                sv = nib.load(cases[idx]["output"]).get_fdata()
+            mask = nib.load(cases[idx]["roi"]).get_fdata()
+            self.assertTrue(np.all(sv[mask == 0] == 0))
+            self.assertEqual(result["n_supervoxels"], len(np.unique(sv[mask > 0])))
+        self.assertTrue(results[2][1]["n_supervoxels"] <= 3)
+
+    def testSerial(self):
+        cases = self._cases()
+        results = dict((idx, (success, result)) for idx, success, result
+                       in run_batch(cases, {"n-supervoxels" : 10}, retries=1))
+        self._check(cases, results)
+
+    def testPool(self):
+        cases = self._cases()
+        results = dict((idx, (success, result)) for idx, success, result
+                       in run_batch(cases, {"n-supervoxels" : 10}, n_workers=2, max_memory=1, retries=2))
+        self._check(cases, results)
+
+    def testLoadBatch(self):
+        fname = os.path.join(self.tempdir, "batch.yaml")
+        with open(fname, "w") as yaml_file:
+            yaml_file.write("""
+n-workers: 3
+summary-file: summary.csv
+Supervoxels:
+  n-supervoxels: 10
+Cases:
+  - data: data0.nii.gz
+    roi: mask0.nii.gz
+    output: out/sv0.nii.gz
+    compactness: 0.2
+""")
+        cases, options, runner_options = load_batch(fname)
+        self.assertEqual(options, {"n-supervoxels" : 10})
+        self.assertEqual(runner_options["n_workers"], 3)
+        self.assertEqual(runner_options["summary_file"], os.path.join(self.tempdir, "summary.csv"))
+        self.assertEqual(cases, [{"data" : os.path.join(self.tempdir, "data0.nii.gz"),
+                                  "roi" : os.path.join(self.tempdir, "mask0.nii.gz"),
+                                  "output" : os.path.join(self.tempdir, "out", "sv0.nii.gz"),
+                                  "compactness" : 0.2}])
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img, self.mask = synthetic_data(24, 5, 0.3)
+        self.kwargs = {"spacing" : [1, 1, 1], "compactness" : 0.05, "n_pca_components" : 3}
+        self.previous = assemble_labels(perfslic_job(self.img, self.mask, 20, self.kwargs),
+                                        (slice(0, 24),) * 3, (24, 24, 24))[0]
+
+    def testNoChange(self):
+        labels, n_new = incremental_slic(self.img, self.mask, self.previous, self.kwargs)
+        self.assertEqual(n_new, 0)
+        self.assertTrue(np.all(labels + 1 == self.previous))
+
+    def testEdit(self):
+        mask = self.mask.copy()
+        inside = np.argwhere(mask > 0)
+        corner = tuple(inside.min(axis=0))
+        mask[corner[0]:corner[0] + 3, corner[1]:corner[1] + 3, corner[2]:corner[2] + 3] = 0
+        mask[11:14, 11:14, 1:4] = 1
+        labels, n_new = incremental_slic(self.img, mask, self.previous, self.kwargs)
+        self.assertTrue(n_new > 0)
+        self.assertTrue(np.all((labels >= 0) == (mask > 0)))
+        # Supervoxels away from the edit keep their labels
+        changed = (mask > 0) != (self.previous > 0)
+        kept = np.setdiff1d(np.unique(self.previous), np.unique(self.previous[binary_dilation(changed, iterations=3)]))
+        self.assertTrue(len(kept) > 0)
+        for label in kept:
+            self.assertTrue(np.all(labels[self.previous == label] == label - 1))
+        # Freed labels are reused so the label range does not grow much
+        self.assertTrue(labels.max() + 1 <= self.previous.max() + n_new)
+
+class WarmStartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img, self.mask = synthetic_data(24, 5, 0.3)
+        self.kwargs = {"spacing" : [1, 1, 1], "compactness" : 0.05, "n_pca_components" : 3}
+        self.previous = perfslic_job(self.img, self.mask, 20, self.kwargs) + 1
+
+    def testWarmStart(self):
+        features = preprocess(self.img, 3, 0, [1, 1, 1])
+        labels, n_iter = warm_slic(features, self.mask, self.previous, 0.05, [1, 1, 1], tol=0.02)
+        self.assertTrue(n_iter < 10)
+        self.assertTrue(np.all((labels >= 0) == (self.mask > 0)))
+        # Supervoxels keep the labels they started from
+        self.assertTrue(np.mean(labels[self.mask > 0] + 1 == self.previous[self.mask > 0]) > 0.8)
+
+    def testMaxIter(self):
+        features = preprocess(self.img, 3, 0, [1, 1, 1])
+        _, n_iter = warm_slic(features, self.mask, self.previous, 0.2, [1, 1, 1], max_iter=2)
+        self.assertEqual(n_iter, 2)
+
+    def testSeedStep(self):
+        # Centres on a grid with steps of 3, 4 and 5 voxels, rounded to voxels first
+        coords = np.mgrid[0:9:3, 0:12:4, 0:15:5].reshape(3, -1).T + 0.2
+        segments = np.concatenate([coords, np.zeros((len(coords), 2))], axis=1)
+        self.assertAlmostEqual(seed_step(segments), 3.0)
+
+class PyramidTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img, self.mask = synthetic_data(32, 5, 0.3)
+        self.kwargs = {"spacing" : [1, 1, 1], "compactness" : 0.05, "n_pca_components" : 3,
+                       "seed_type" : "nplace", "recompute_seeds" : True}
+
+    def testFactors(self):
+        self.assertEqual(pyramid_factors([1, 1, 1], 2), (2, 2, 2))
+        self.assertEqual(pyramid_factors([1, 1, 4], 2), (2, 2, 1))
+        self.assertEqual(pyramid_factors([0.5, 1, 1], 4), (4, 2, 2))
+
+    def testResample(self):
+        arr = np.arange(5 * 4 * 3, dtype=np.float32).reshape((5, 4, 3))
+        small = downsample(arr, (2, 2, 1))
+        self.assertEqual(small.shape, (3, 2, 3))
+        self.assertAlmostEqual(small[0, 0, 0], np.mean(arr[:2, :2, 0]))
+        # Edge blocks are padded with the last voxel
+        self.assertAlmostEqual(small[2, 0, 0], np.mean(arr[4, :2, 0]))
+        self.assertEqual(downsample(np.zeros((4, 4, 4, 3)), (2, 2, 2)).shape, (2, 2, 2, 3))
+
+        labels = upsample_labels(np.arange(8).reshape((2, 2, 2)), (2, 2, 2), (3, 4, 4))
+        self.assertEqual(labels.shape, (3, 4, 4))
+        self.assertEqual(labels[2, 3, 0], 6)
+
+    def testPyramid(self):
+        features = preprocess(self.img, 3, 0, [1, 1, 1])
+        labels = pyramid_slic(features, self.mask, 20, self.kwargs)
+        self.assertTrue(np.all((labels >= 0) == (self.mask > 0)))
+        self.assertTrue(10 <= len(np.unique(labels[labels >= 0])) <= 20)
+
+    def testCoarse(self):
+        features = preprocess(self.img, 3, 0, [1, 1, 1])
+        self.assertEqual(fit_factor((32, 32, 32), [1, 1, 1], 32**3), 1)
+        self.assertEqual(fit_factor((32, 32, 32), [1, 1, 1], 4096), 2)
+        self.assertEqual(fit_factor((32, 32, 8), [1, 1, 4], 1000), 3)
+        labels = coarse_slic(features, self.mask, 10, self.kwargs, factor=4)
+        self.assertTrue(np.all((labels >= 0) == (self.mask > 0)))
+
+class SupervoxelStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img, self.mask = synthetic_data(16, 6, 0.4)
+        self.labels = perfslic_job(self.img, self.mask, 8, {"compactness" : 0.05, "n_pca_components" : 3})
+
+    def testStats(self):
+        stats = supervoxel_stats(self.labels, self.img, offset=(2, 0, 1))
+        for idx, label in enumerate(stats["label"]):
+            inside = self.labels == label - 1
+            values = self.img[inside]
+            self.assertEqual(stats["voxels"][idx], np.count_nonzero(inside))
+            self.assertTrue(np.allclose(stats["centroid"][idx], np.argwhere(inside).mean(axis=0) + [2, 0, 1]))
+            self.assertAlmostEqual(stats["mean"][idx], values.mean(), places=5)
+            self.assertAlmostEqual(stats["std"][idx], values.std(), places=5)
+            self.assertTrue(np.allclose(stats["timecourse"][idx], values.mean(axis=0), atol=1e-5))
+
+    def test3d(self):
+        stats = supervoxel_stats(self.labels, self.img[..., 0])
+        self.assertTrue(stats["timecourse"] is None)
+        label = stats["label"][0]
+        self.assertAlmostEqual(stats["mean"][0], self.img[..., 0][self.labels == label - 1].mean(), places=5)
+
+class AdjacencyTest(unittest.TestCase):
+
+    def testPairs(self):
+        labels = -np.ones((4, 4, 3), dtype=np.int32)
+        labels[:2, :, :2] = 0
+        labels[2:, :, :2] = 1
+        labels[:, :, 2] = 2
+        labels[3, 3, 2] = -1
+        pairs, boundary = adjacent_pairs(labels)
+        self.assertEqual(pairs.tolist(), [[0, 1], [0, 2], [1, 2]])
+        self.assertEqual(boundary.tolist(), [8, 8, 7])
+
+        distance = feature_distances(pairs, [[0, 0], [3, 4], [0, 1]])
+        self.assertTrue(np.allclose(distance, [5, 1, np.sqrt(18)]))
+
+        matrix = adjacency_matrix(pairs, boundary, 3)
+        self.assertEqual(matrix.shape, (4, 4))
+        self.assertTrue(np.all(matrix.toarray() == matrix.toarray().T))
+        self.assertEqual(matrix[2, 3], 7)
+        self.assertEqual(matrix[0].nnz, 0)
+
+    def testSaveLoad(self):
+        labels = perfslic_job(*synthetic_data(16, 1, 0.5), n_supervoxels=6,
+                              slic_kwargs={"compactness" : 0.1, "n_pca_components" : 3})
+        pairs, boundary = adjacent_pairs(labels)
+        distance = np.arange(len(pairs), dtype=np.double)
+        tempdir = tempfile.mkdtemp("_qp_sv")
+        try:
+            fname = os.path.join(tempdir, "graph.npz")
+            save_adjacency(fname, pairs, boundary, distance, labels.max() + 1)
+            loaded_boundary, loaded_distance = load_adjacency(fname)
+        finally:
+            shutil.rmtree(tempdir)
+        expected = adjacency_matrix(pairs, boundary, labels.max() + 1)
+        self.assertEqual((loaded_boundary != expected).nnz, 0)
+        # Zero distances are still stored as edges
+        self.assertEqual(loaded_distance.nnz, loaded_boundary.nnz)
+        self.assertEqual(loaded_distance[pairs[1, 0] + 1, pairs[1, 1] + 1], 1)
+
+class CleanupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img, self.mask = synthetic_data(20, 4, 0.3)
+        self.labels = perfslic_job(self.img, self.mask, 12, {"compactness" : 0.01, "n_pca_components" : 3})
+
+    def testFragments(self):
+        expected = sum(connected_label(self.labels == label)[1] for label in np.unique(self.labels[self.labels >= 0]))
+        for thickness in (1, 3, 20):
+            fragments, n_fragments = connected_fragments(self.labels, thickness)
+            self.assertEqual(n_fragments, expected)
+            self.assertTrue(np.all((fragments >= 0) == (self.labels >= 0)))
+
+    def testCleanup(self):
+        labels = self.labels.copy()
+        # An isolated stray voxel inside another supervoxel
+        inside = np.argwhere(labels == 0)[len(np.argwhere(labels == 0)) // 2]
+        labels[tuple(inside)] = 1
+        cleaned, n_merged = cleanup_labels(labels, 20)
+        self.assertTrue(n_merged > 0)
+        self.assertTrue(np.all((cleaned >= 0) == (labels >= 0)))
+        values = np.unique(cleaned[cleaned >= 0])
+        self.assertEqual(values.tolist(), list(range(len(values))))
+        for value in values:
+            region = cleaned == value
+            self.assertEqual(connected_label(region)[1], 1)
+            self.assertTrue(np.count_nonzero(region) >= 20)
+
+        # The memory budget only changes the slab size, not the result
+        small, _ = cleanup_labels(labels, 20, max_memory=0)
+        self.assertTrue(np.all(small == cleaned))
+
+class EngineTest(unittest.TestCase):
+
+    def testEquivalence(self):
+        for size, nvols, n_supervoxels, kwargs in [
+                (16, 6, 8, {"compactness" : 0.05}),
+                (20, 4, 12, {"compactness" : 0.01, "sigma" : 0.5, "spacing" : [1, 1, 2]}),
+                (32, 1, 30, {"compactness" : 0.1, "sigma" : 1})]:
+            img, mask = synthetic_data(size, nvols, 0.3)
+            kwargs = dict(kwargs, n_pca_components=3, seed_type="nplace", recompute_seeds=True, random_state=1)
+            expected = perfslic_job(img, mask, n_supervoxels, kwargs)
+            labels = numpy_perfslic_job(img, mask, n_supervoxels, kwargs)
+            self.assertTrue(np.all(labels == expected))
+
+    def testRandomState(self):
+        img, mask = synthetic_data(16, 6, 0.3)
+        # Without a random state the PCA matches perfslic's, using the global generator
+        np.random.seed(1)
+        expected = preprocess_pca(img, 3)
+        np.random.seed(1)
+        self.assertTrue(np.allclose(pca_features(img, 3), expected))
+        np.random.seed(1)
+        expected = maskslic.perfslic(img, mask, n_supervoxels=10)
+        np.random.seed(1)
+        self.assertTrue(np.all(perfslic_job(img, mask, 10, {}) == expected))
+
+        # A random state seeds the run as if the global generator had been seeded,
+        # and the global generator is left as it was
+        np.random.seed(2)
+        state = np.random.get_state()[1].copy()
+        np.random.seed(1)
+        expected = preprocess_pca(img, 3)
+        np.random.seed(2)
+        self.assertTrue(np.all(pca_features(img, 3, random_state=1) == expected))
+        self.assertTrue(np.all(np.random.get_state()[1] == state))
+        np.random.seed(1)
+        expected = maskslic.perfslic(img, mask, n_supervoxels=10)
+        np.random.seed(3)
+        self.assertTrue(np.all(perfslic_job(img, mask, 10, {"random_state" : 1}) == expected))
+
+    def testBatches(self):
+        img, mask = synthetic_data(24, 1, 0.5)
+        features = preprocess(img, 3, 0, [1, 1, 1])
+        kwargs = {"compactness" : 0.1, "seed_type" : "grid", "recompute_seeds" : False}
+        expected = maskslic.slic(features, n_segments=40, mask=mask, multichannel=False, multifeat=True, **kwargs)
+        # Batch size only limits memory use
+        for batch_voxels in (1, 10000, 2**24):
+            labels = numpy_slic(features, mask, 40, batch_voxels=batch_voxels, **kwargs)
+            self.assertTrue(np.all(labels == expected))
+
+    def testRegistry(self):
+        self.assertTrue("maskslic" in engine_names())
+        self.assertTrue("numpy" in engine_names())
+        self.assertRaises(QpException, get_engine, "nonexistent")
+
+    def testUnsupportedOptions(self):
+        # maskslic options the numpy engine does not implement are named in the error
+        img, mask = synthetic_data(12, 1, 0.5)
+        with self.assertRaises(QpException) as context:
+            numpy_perfslic_job(img, mask, 4, {"compactness" : 0.1, "slic_zero" : True,
+                                              "enforce_connectivity" : True, "random_state" : 1})
+        self.assertTrue("enforce_connectivity, slic_zero" in str(context.exception))
+
+    def testThreads(self):
+        img, mask = synthetic_data(24, 1, 0.5)
+        features = preprocess(img, 3, 0, [1, 1, 1])
+        kwargs = {"compactness" : 0.1, "seed_type" : "grid", "recompute_seeds" : True}
+        expected = numpy_slic(features, mask, 40, **kwargs)
+        for threads in (2, 3, 16):
+            slabs = _slabs(mask, threads)
+            self.assertEqual(slabs[0][0], 0)
+            self.assertEqual(slabs[-1][1], mask.shape[0])
+            self.assertTrue(all(first[1] == second[0] for first, second in zip(slabs[:-1], slabs[1:])))
+            self.assertTrue(np.all(numpy_slic(features, mask, 40, threads=threads, **kwargs) == expected))
+
+class PrecisionTest(unittest.TestCase):
+
+    def setUp(self):
+        img, self.mask = synthetic_data(16, 6, 0.4)
+        self.img = img.astype(np.float64)
+
+    def testCrop(self):
+        grid = DataGrid(self.mask.shape, np.identity(4))
+        data = NumpyData(self.img, grid=grid, name="data")
+        box = (slice(2, 12), slice(0, 16), slice(3, 9))
+        for dtype in (np.float32, np.float64):
+            crop = crop_data(data, box, dtype=dtype)
+            self.assertEqual(crop.dtype, dtype)
+            self.assertTrue(crop.flags.c_contiguous)
+            self.assertTrue(np.allclose(crop, self.img[box]))
+        # Without a type the crop is a view of the data
+        self.assertTrue(np.shares_memory(crop_data(data, box), data.raw()))
+
+    def testStreamingPca(self):
+        single = self.img.astype(np.float32)
+        copy = single.copy()
+        features = streaming_pca(single, 3, batch=16)
+        # The input must not be modified even when a slab covers all of it
+        self.assertTrue(np.all(single == copy))
+        self.assertTrue(np.allclose(features, streaming_pca(self.img, 3), atol=1e-3))
+
+    def testAgreement(self):
+        labels = np.array([0, 1, 1, 2, 2, 2])
+        self.assertEqual(label_agreement(labels, labels), (1.0, 1.0))
+        same, matched = label_agreement(labels, np.array([0, 2, 2, 1, 1, 3]))
+        self.assertAlmostEqual(same, 0.0)
+        self.assertAlmostEqual(matched, 0.8)
+
+class SmoothingTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(3)
+        self.features = np.random.rand(24, 20, 12, 3).astype(np.float32)
+
+    def testWidths(self):
+        for sigma in (2, 3.5, 5, 12):
+            widths = box_widths(sigma)
+            self.assertEqual(len(widths), 3)
+            self.assertTrue(all(width % 2 == 1 for width in widths))
+            self.assertAlmostEqual(np.sqrt(sum((w * w - 1) / 12.0 for w in widths)), sigma, delta=0.25)
+
+    def testThreads(self):
+        expected = smooth_features(self.features, 1.5, [1, 1, 2])
+        smoothed = smooth_features(self.features, 1.5, [1, 1, 2], threads=3)
+        self.assertEqual(smoothed.dtype, np.float32)
+        self.assertTrue(np.allclose(smoothed, expected, atol=1e-6))
+
+    def testBox(self):
+        # Spacing of 4 along the last axis takes the kernel below the box filter minimum
+        expected = smooth_features(self.features, [6, 8, 3], [1, 1, 1])
+        for threads in (1, 2):
+            smoothed = smooth_features(self.features, 12, [2, 1.5, 4], "box", threads)
+            self.assertEqual(smoothed.shape, self.features.shape)
+            self.assertTrue(np.abs(smoothed - expected).max() < 0.02)
+        self.assertTrue(smooth_features(self.features, 0, [1, 1, 1], "box") is self.features)
+        self.assertRaises(QpException, smooth_features, self.features, 2, [1, 1, 1], "median")
+
+class ModalityTest(unittest.TestCase):
+
+    def setUp(self):
+        img, self.mask = synthetic_data(16, 4, 0.5)
+        self.grid = DataGrid(self.mask.shape, np.identity(4))
+        self.t1 = NumpyData(img[..., 0] * 100 + 50, grid=self.grid, name="t1")
+        self.t2 = NumpyData(img[..., 1:], grid=self.grid, name="t2")
+
+    def testCrop(self):
+        box = (slice(2, 12), slice(0, 16), slice(3, 9))
+        mask = self.mask[box] > 0
+        stack = ModalityStack([self.t1, self.t2], ["range", "zscore"], [2, 1]).crop(box, mask)
+        self.assertEqual(stack.shape, (10, 16, 6, 4))
+        self.assertEqual(stack.dtype, np.float32)
+        self.assertAlmostEqual(stack[..., 0][mask].min(), 0, places=5)
+        self.assertAlmostEqual(stack[..., 0][mask].max(), 2, places=5)
+        self.assertAlmostEqual(stack[..., 1:][mask].mean(), 0, places=4)
+        self.assertAlmostEqual(stack[..., 1:][mask].std(), 1, places=4)
+
+        stack = ModalityStack([self.t1, self.t2], "none").crop(box, mask)
+        self.assertTrue(np.allclose(stack[..., 0], self.t1.raw()[box]))
+        self.assertTrue(np.allclose(stack[..., 1:], self.t2.raw()[box]))
+
+    def testInvalid(self):
+        other = NumpyData(self.t1.raw()[:8], grid=DataGrid((8, 16, 16), np.identity(4)), name="other")
+        self.assertRaises(QpException, ModalityStack, [self.t1, other])
+        self.assertRaises(QpException, ModalityStack, [self.t1, self.t2], "median")
+        self.assertRaises(QpException, ModalityStack, [self.t1, self.t2], "range", [1])
+        self.assertRaises(QpException, ModalityStack, [])
+
+    def testFeatures(self):
+        box = (slice(0, 16), slice(0, 16), slice(0, 16))
+        stack = ModalityStack([self.t1, self.t2]).crop(box, self.mask)
+        self.assertTrue(np.all(modality_features(stack, 4) == stack))
+        features = modality_features(stack, 2)
+        self.assertEqual(features.shape, (16, 16, 16, 2))
+        self.assertTrue(np.allclose(features.min(axis=(0, 1, 2)), 0))
+
 if __name__ == '__main__':
     unittest.main()
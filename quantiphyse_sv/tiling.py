@@ -0,0 +1,217 @@
+"""
+Quantiphyse - Tiled supervoxel generation for large volumes
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import itertools
+import math
+
+import numpy as np
+
+from .parallel import run_jobs, perfslic_job
+
+# Largest merged supervoxel allowed when stitching, as a multiple of the
+# mean supervoxel size. Matches the default max_size_factor used by maskslic
+MAX_SIZE_FACTOR = 3
+
+def bytes_per_voxel(nvols, ncomp, itemsize=8):
+    """
+    Rough working memory needed per voxel by a single perfslic call
+
+    This covers the input data, the PCA features and their normalised copy,
+    and the per-voxel label/distance arrays used by the SLIC iterations.
+    The features and the SLIC arrays are double precision.
+
+    :param itemsize: Bytes per value of the input data
+    """
+    return itemsize * nvols + 8 * (2 * min(ncomp, nvols) + 4)
+
+def data_itemsize(img):
+    """
+    Bytes per value of image data as it will be read, which for a
+    ``MappedCrop`` may differ from the type stored in the file
+    """
+    return np.asarray(img[:1, :1, :1]).dtype.itemsize
+
+def plan_tiles(shape, max_voxels, overlap):
+    """
+    Split a 3D box into overlapping tiles
+
+    The longest tile axis is split repeatedly until a tile, including its
+    overlap, holds no more than ``max_voxels`` voxels.
+
+    :return: List of (core slices, extended slices) tuples. The core regions
+             partition the box, the extended regions add ``overlap`` voxels
+             on each interior face
+    """
+    ntiles = [1] * len(shape)
+    while True:
+        core = [int(math.ceil(float(size) / n)) for size, n in zip(shape, ntiles)]
+        ext = [min(size, c + 2 * overlap * (n > 1)) for size, c, n in zip(shape, core, ntiles)]
+        if np.prod(ext) <= max_voxels:
+            break
+        axis = int(np.argmax(core))
+        if core[axis] <= max(1, 2 * overlap):
+            # Can't usefully split any further - tiles will exceed the budget
+            break
+        ntiles[axis] += 1
+
+    bounds = [np.linspace(0, size, n + 1).astype(int) for size, n in zip(shape, ntiles)]
+    tiles = []
+    for idx in itertools.product(*[range(n) for n in ntiles]):
+        core, ext = [], []
+        for axis, i in enumerate(idx):
+            start, stop = bounds[axis][i], bounds[axis][i + 1]
+            core.append(slice(start, stop))
+            ext.append(slice(max(0, start - overlap), min(shape[axis], stop + overlap)))
+        tiles.append((tuple(core), tuple(ext)))
+    return tiles
+
+class _UnionFind(object):
+    """
+    Minimal union-find over integer labels, tracking merged sizes
+    """
+    def __init__(self, sizes):
+        self.parent = np.arange(len(sizes))
+        self.size = np.array(sizes, dtype=np.int64)
+
+    def find(self, label):
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, label1, label2, max_size):
+        root1, root2 = self.find(label1), self.find(label2)
+        if root1 == root2 or self.size[root1] + self.size[root2] > max_size:
+            return
+        self.parent[root2] = root1
+        self.size[root1] += self.size[root2]
+
+    def roots(self):
+        return np.array([self.find(label) for label in range(len(self.parent))], dtype=np.int32)
+
+def _halo(ext, local_core):
+    """
+    :return: Boolean mask of the overlap voxels of an extended tile
+    """
+    halo = np.ones(tuple(e.stop - e.start for e in ext), dtype=bool)
+    halo[local_core] = False
+    return halo
+
+def _stitch(out, halos, n_labels, max_size):
+    """
+    Merge supervoxels which were split by a tile seam
+
+    Each tile's labels within its overlap region are compared with the labels
+    written by the neighbouring tile's core. A tile label is merged with the
+    neighbouring label covering most of its overlap voxels if that label
+    covers at least half of them, or if most of the tile label lies in the
+    overlap (so it is really a fragment of a neighbouring supervoxel).
+    Merges which would create a supervoxel larger than ``max_size`` are
+    skipped.
+
+    :param halos: List of (extended slices, core slices relative to the extended
+                  box, tile labels of the overlap voxels) for each tile
+    """
+    inside = out >= 0
+    uf = _UnionFind(np.bincount(out[inside], minlength=n_labels))
+    core_counts = np.copy(uf.size)
+    for ext, local_core, tile_labels in halos:
+        neighbour_labels = out[ext][_halo(ext, local_core)]
+        halo_counts = np.bincount(tile_labels[tile_labels >= 0], minlength=n_labels)
+        valid = (tile_labels >= 0) & (neighbour_labels >= 0)
+        if not np.any(valid):
+            continue
+        pairs, counts = np.unique(np.stack([tile_labels[valid], neighbour_labels[valid]], axis=1),
+                                  axis=0, return_counts=True)
+
+        # Best matching neighbour label for each tile label. Pairs are sorted by
+        # tile label so take the last of each group after a stable sort by count
+        order = np.lexsort((counts, pairs[:, 0]))
+        pairs, counts = pairs[order], counts[order]
+        last = np.append(pairs[1:, 0] != pairs[:-1, 0], True)
+        for (tile_label, neighbour_label), count in zip(pairs[last], counts[last]):
+            if core_counts[tile_label] == 0:
+                continue
+            if 2 * count >= halo_counts[tile_label] or core_counts[tile_label] < halo_counts[tile_label]:
+                uf.union(neighbour_label, tile_label, max_size)
+
+    roots = uf.roots()
+    _, out[inside] = np.unique(roots[out[inside]], return_inverse=True)
+    return out
+
+def tiled_slic(img, mask, n_supervoxels, slic_kwargs, tile_memory=512, overlap=4, n_workers=1,
+               slic_fn=perfslic_job, progress=None):
+    """
+    Run perfslic over overlapping tiles of a cropped image and stitch the result
+
+    Each tile is seeded independently with a share of ``n_supervoxels``
+    proportional to the number of ROI voxels in its core. Only the labels of
+    each tile's overlap voxels are kept for stitching. Tiles may be run in
+    a process pool, in which case peak memory is roughly ``n_workers`` times
+    the per-tile budget.
+
+    The budget only covers the working memory of the tiles. Memory use is
+    only bounded if ``img`` is a ``source.MappedCrop`` (the ``memory-map``
+    option); an array holds the whole cropped image in memory as well.
+
+    :param img: Cropped 3D or 4D image data
+    :param mask: Cropped 3D mask
+    :param n_supervoxels: Total number of supervoxels to aim for
+    :param slic_kwargs: Other keyword arguments passed to ``maskslic.perfslic``
+    :param tile_memory: Working memory budget per tile in Mb
+    :param overlap: Overlap between neighbouring tiles in voxels
+    :param n_workers: Number of tiles to process in parallel
+    :param slic_fn: Picklable job function used to cluster each tile
+    :param progress: Optional callable taking the fraction of tiles completed
+    :return: Labels in the same convention as perfslic, i.e. -1 outside the mask
+    """
+    nvols = img.shape[3] if img.ndim == 4 else 1
+    ncomp = slic_kwargs.get("n_pca_components", 3) or nvols
+    max_voxels = int(tile_memory * 1024 * 1024 / bytes_per_voxel(nvols, ncomp, data_itemsize(img)))
+    total = np.count_nonzero(mask)
+
+    tiles = []
+    for core, ext in plan_tiles(mask.shape, max_voxels, overlap):
+        count = np.count_nonzero(mask[core])
+        if count > 0:
+            n_tile = int(min(count, max(1, round(float(n_supervoxels) * count / total))))
+            tiles.append((core, ext, n_tile))
+
+    jobs = ((img[ext], mask[ext], n_tile, slic_kwargs) for _core, ext, n_tile in tiles)
+    out = -np.ones(mask.shape, dtype=np.int32)
+    halos = []
+    n_labels = 0
+    for done, (idx, labels) in enumerate(run_jobs(slic_fn, jobs, n_workers), 1):
+        if progress is not None:
+            progress(float(done) / len(tiles))
+        core, ext, _ = tiles[idx]
+        labels = np.array(labels, dtype=np.int32)
+        inside = labels >= 0
+        if not np.any(inside):
+            continue
+        labels[inside] += n_labels
+        n_labels = labels.max() + 1
+        local_core = tuple(slice(c.start - e.start, c.stop - e.start) for c, e in zip(core, ext))
+        out[core] = labels[local_core]
+        if len(tiles) > 1:
+            halos.append((ext, local_core, labels[_halo(ext, local_core)]))
+
+    max_size = MAX_SIZE_FACTOR * float(total) / n_supervoxels
+    return _stitch(out, halos, n_labels, max_size)
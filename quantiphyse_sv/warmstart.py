@@ -0,0 +1,137 @@
+"""
+Quantiphyse - Warm-start supervoxel clustering from previous labels
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
+
+from quantiphyse.utils import QpException
+
+from .parallel import single_label
+from .numpyslic import BATCH_VOXELS, _iterate
+
+def seeds_from_labels(labels, image):
+    """
+    Cluster centres for SLIC from an existing label volume
+
+    :param labels: Label volume, -1 where unlabelled
+    :param image: Scaled 4D feature volume as used by the SLIC iterations
+    :return: Tuple of (label values, array of shape (N, 3 + channels) containing
+             the centroid and mean features of each label in the layout used by
+             maskslic)
+    """
+    inside = labels >= 0
+    values, idx = np.unique(labels[inside], return_inverse=True)
+    counts = np.bincount(idx).astype(np.double)
+    columns = [np.bincount(idx, weights=coords) / counts for coords in np.nonzero(inside)]
+    feats = image[inside]
+    columns += [np.bincount(idx, weights=feats[:, chan]) / counts for chan in range(feats.shape[1])]
+    return values, np.ascontiguousarray(np.stack(columns, axis=1), dtype=np.double)
+
+def seed_step(segments):
+    """
+    SLIC search step for a set of centres, calculated in the same way as
+    maskslic does for its own seed points
+
+    This is the largest per-axis mean distance from a centre to its nearest
+    neighbour, with the centres rounded to voxels.
+    """
+    coords = np.round(segments[:, :3])
+    _, nearest = cKDTree(coords).query(coords, k=2)
+    return float(np.float32(max(np.mean(np.abs(coords - coords[nearest[:, 1]]), axis=0))))
+
+def fill_unassigned(labels, mask):
+    """
+    Give voxels in the mask which no centre reached the label of the nearest labelled voxel
+    """
+    unassigned = (labels < 0) & mask
+    if np.any(unassigned) and np.any(labels >= 0):
+        nearest = distance_transform_edt(labels < 0, return_distances=False, return_indices=True)
+        labels = np.where(unassigned, labels[tuple(nearest)], labels)
+    return labels
+
+def warm_slic(features, mask, initial, compactness=0.1, spacing=None, max_iter=10, tol=0.0):
+    """
+    Run the SLIC iterations starting from the centres of an existing label volume
+
+    Unlike maskslic, which always runs ``max_iter`` iterations, this stops as
+    soon as the fraction of voxels which change label in an iteration is no
+    more than ``tol``. The iterations are those of ``numpyslic``, run one at
+    a time. Starting from a previous result for similar data
+    usually needs far fewer iterations, and the seed placement is skipped
+    completely. Each supervoxel keeps the label of the initial supervoxel it
+    started from, so labels correspond between the two results.
+
+    :param features: Smoothed feature volume with channels along the last axis,
+                     from ``features.preprocess``
+    :param mask: Cropped mask
+    :param initial: Cropped initial labels, greater than zero inside the supervoxels
+                    (e.g. a previous supervoxel ROI)
+    :param compactness: Compactness, as for ``maskslic.slic``
+    :param spacing: Voxel spacing
+    :param max_iter: Maximum number of iterations
+    :param tol: Fraction of voxels which may still change label at convergence
+    :return: Tuple of (labels with -1 outside the mask, number of iterations run)
+    """
+    mask = np.asarray(mask) > 0
+    initial = np.where(mask, np.asarray(initial), 0).astype(np.int64) - 1
+    image = np.asarray(features / compactness, dtype=np.double)
+    if image.ndim == 3:
+        image = image[..., np.newaxis]
+
+    if not np.any(initial >= 0):
+        raise QpException("Initial labels do not overlap the ROI")
+    values, segments = seeds_from_labels(initial, image)
+    if len(segments) < 2:
+        return single_label(mask), 0
+
+    step = seed_step(segments)
+    if spacing is None:
+        spacing = np.ones(3)
+    spacing = np.asarray(spacing, dtype=np.double)
+    feat_norm = float(image.shape[3])
+    # Channels first, as used by the numpyslic iterations
+    scaled = np.ascontiguousarray(np.moveaxis(image, -1, 0).reshape(image.shape[3], -1))
+    n_voxels = np.count_nonzero(mask)
+
+    def _one_iteration():
+        return _iterate(scaled, mask, segments, step, 1, spacing, feat_norm, False, BATCH_VOXELS)
+
+    labels, n_iter = None, 0
+    while n_iter < max_iter:
+        # A single iteration assigns voxels to the current centres and then
+        # updates the centres in place
+        new_labels = _one_iteration()
+        n_iter += 1
+        converged = labels is not None and np.count_nonzero(new_labels != labels) <= tol * n_voxels
+        labels = new_labels
+
+        empty = ~np.all(np.isfinite(segments), axis=1)
+        if np.any(empty):
+            # Centres which lost all their voxels cannot be updated
+            segments = np.ascontiguousarray(segments[~empty])
+            values = values[~empty]
+            labels = None
+        elif converged:
+            break
+
+    if labels is None:
+        labels = _one_iteration()
+        n_iter += 1
+    labels = np.where(labels >= 0, values[labels], -1)
+    return fill_unassigned(labels, mask), n_iter
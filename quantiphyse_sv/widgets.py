@@ -18,14 +18,32 @@ limitations under the License.
 
 from PySide2 import QtGui, QtCore, QtWidgets
 
-from quantiphyse.gui.widgets import QpWidget, TitleWidget, Citation, OverlayCombo, RoiCombo, NumericOption
+from quantiphyse.gui.widgets import QpWidget, TitleWidget, Citation, OverlayCombo, RoiCombo, NumericOption, RunWidget
 
 from .process import SupervoxelsProcess
+from .engines import engine_names, DEFAULT_ENGINE
 
 CITE_TITLE = "maskSLIC: Regional Superpixel Generation with Application to Local Pathology Characterisation in Medical Images"
 CITE_AUTHOR = "Benjamin Irving"
 CITE_JOURNAL = "https://arxiv.org/abs/1606.09518v2 (2017)"
 
+PREVIEW_SUFFIX = "_preview"
+
+class _ClusterRoiCombo(RoiCombo):
+    """
+    ROI combo which leaves out the live preview ROIs, so a preview
+    can never be chosen as the ROI to cluster within
+    """
+    def _data_changed(self):
+        super(_ClusterRoiCombo, self)._data_changed()
+        self.blockSignals(True)
+        try:
+            for idx in reversed(range(self.count())):
+                if self.itemText(idx).endswith(PREVIEW_SUFFIX):
+                    self.removeItem(idx)
+        finally:
+            self.blockSignals(False)
+
 class PerfSlicWidget(QpWidget):
     """
     Generates supervoxels using SLIC method
@@ -56,7 +74,7 @@ class PerfSlicWidget(QpWidget):
         self.ovl.currentIndexChanged.connect(self._data_changed)
         grid.addWidget(self.ovl, 0, 1)
         grid.addWidget(QtWidgets.QLabel("ROI"), 1, 0)
-        self.roi = RoiCombo(self.ivm)
+        self.roi = _ClusterRoiCombo(self.ivm)
         grid.addWidget(self.roi, 1, 1)
 
         self.n_comp = NumericOption("Number of components", grid, 2, minval=1, maxval=3, default=3, intonly=True)
@@ -68,13 +86,53 @@ class PerfSlicWidget(QpWidget):
         self.output_name = QtWidgets.QLineEdit("supervoxels")
         grid.addWidget(self.output_name, 6, 1)
 
-        self.gen_btn = QtWidgets.QPushButton('Generate', self)
-        self.gen_btn.clicked.connect(self._generate)
-        grid.addWidget(self.gen_btn, 7, 0)
+        self.incremental = QtWidgets.QCheckBox("Only update supervoxels near ROI edits")
+        grid.addWidget(self.incremental, 7, 0, 1, 2)
+
+        self.stats = QtWidgets.QCheckBox("Output supervoxel statistics table")
+        grid.addWidget(self.stats, 8, 0, 1, 2)
+
+        # Preview runs on downsampled data shortly after the last option change
+        self.preview = QtWidgets.QCheckBox("Live preview")
+        self.preview.stateChanged.connect(self._preview_toggled)
+        grid.addWidget(self.preview, 9, 0, 1, 2)
+        self._preview_timer = QtCore.QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(300)
+        self._preview_timer.timeout.connect(self._run_preview)
+        self._preview_process = None
+        self._preview_pending, self._preview_discard = False, False
+        for option in (self.n_comp, self.compactness, self.sigma, self.n_supervoxels):
+            option.sig_changed.connect(self._schedule_preview)
+        self.ovl.currentIndexChanged.connect(self._schedule_preview)
+        self.roi.currentIndexChanged.connect(self._schedule_preview)
+
+        self.threads = NumericOption("Threads", grid, 10, minval=1, maxval=64, default=1, intonly=True)
+
+        # Box smoothing is only faster than Gaussian smoothing for kernels wider than
+        # BOX_MIN_SIGMA voxels, and then gives slightly different supervoxels
+        self.box_smoothing = QtWidgets.QCheckBox("Approximate wide smoothing kernels with box filters")
+        grid.addWidget(self.box_smoothing, 11, 0, 1, 2)
+
+        # Threads are used for smoothing with any engine and for the assignment step of threaded
+        # engines, which does not necessarily make them faster than maskslic (see benchmark.py)
+        grid.addWidget(QtWidgets.QLabel("Clustering engine"), 12, 0)
+        self.engine = QtWidgets.QComboBox()
+        for name in engine_names():
+            self.engine.addItem(name)
+        self.engine.setCurrentIndex(self.engine.findText(DEFAULT_ENGINE))
+        grid.addWidget(self.engine, 12, 1)
+
         hbox.addWidget(optbox)
         hbox.addStretch(1)
         layout.addLayout(hbox)
 
+        # Generation runs in the background with progress and a cancel button
+        self.run_box = RunWidget(self, title="Generate", btn_label="Generate")
+        self.gen_btn = self.run_box.runBtn
+        self.gen_btn.clicked.connect(self._clear_preview)
+        layout.addWidget(self.run_box)
+
         layout.addStretch(1)
 
     def _data_changed(self, _):
@@ -84,6 +142,55 @@ class PerfSlicWidget(QpWidget):
             self.n_comp.label.setVisible(ovl.nvols > 1)
             self.n_comp.spin.setVisible(ovl.nvols > 1)
 
+    def _preview_name(self):
+        return self.output_name.text() + PREVIEW_SUFFIX
+
+    def _preview_toggled(self, _):
+        if self.preview.isChecked():
+            self._schedule_preview()
+        else:
+            self._clear_preview()
+
+    def _schedule_preview(self, *_):
+        if self.preview.isChecked():
+            self._preview_timer.start()
+
+    def _run_preview(self):
+        if not self.preview.isChecked() or not self.ovl.currentText():
+            return
+        if self._preview_process is not None:
+            # Rerun when the current preview finishes, using the latest options
+            self._preview_pending = True
+            return
+
+        options = self.processes()["Supervoxels"]
+        options.pop("previous", None)
+        options.pop("stats", None)
+        options.update({"preview" : True, "output-name" : self._preview_name()})
+        self._preview_discard = False
+        self._preview_process = SupervoxelsProcess(self.ivm)
+        self._preview_process.sig_finished.connect(self._preview_finished)
+        self._preview_process.execute(options)
+
+    def _preview_finished(self, *_):
+        self._preview_process = None
+        if self._preview_discard or not self.preview.isChecked():
+            self._clear_preview()
+        elif self._preview_pending:
+            self._preview_pending = False
+            self._run_preview()
+
+    def _clear_preview(self, *_):
+        """
+        Remove the preview overlay, e.g. when a full resolution run starts
+        """
+        self._preview_timer.stop()
+        self._preview_pending = False
+        # A preview which is still running is removed when it finishes
+        self._preview_discard = self._preview_process is not None
+        if self._preview_name() in self.ivm.rois:
+            self.ivm.delete(self._preview_name())
+
     def batch_options(self):
         options = {
             "data" : self.ovl.currentText(),
@@ -92,10 +199,21 @@ class PerfSlicWidget(QpWidget):
             "compactness" : self.compactness.spin.value(),
             "sigma" : self.sigma.spin.value(),
             "n-supervoxels" :  self.n_supervoxels.spin.value(),
-            "output-name" :  self.output_name.text() 
+            "output-name" :  self.output_name.text(),
         }
+        # Options at their default values are left out of saved batch scripts
+        if self.stats.isChecked():
+            options["stats"] = True
+        if self.threads.spin.value() > 1:
+            options["threads"] = self.threads.spin.value()
+        if self.box_smoothing.isChecked():
+            options["smoothing"] = "box"
+        if self.engine.currentText() != DEFAULT_ENGINE:
+            options["engine"] = self.engine.currentText()
+        if self.incremental.isChecked() and self.output_name.text() in self.ivm.rois:
+            options["previous"] = self.output_name.text()
         return "Supervoxels", options
 
-    def _generate(self):
-        process = SupervoxelsProcess(self.ivm, sync=True)
-        process.run(self.batch_options()[1])
+    def processes(self):
+        # Interactive runs reuse features between runs with different options
+        return {"Supervoxels" : dict(self.batch_options()[1], **{"feature-cache" : True})}